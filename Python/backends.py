@@ -0,0 +1,572 @@
+"""
+    backends.py - Audio sources and sinks
+
+    Every backend reads and writes interleaved integer frames as bytes,
+    so the same processing code can run against a sound card, a wav file,
+    a generated test signal or nothing at all.
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+import wave
+
+import numpy as np
+
+from dsp import Resampler
+from wavfile import MappedWav
+
+SAMPLE_TYPES = {2: np.int16, 4: np.int32}
+
+
+class Backend:
+    """
+    Source and/or sink of interleaved audio frames.
+    """
+    rate = 0
+    channels = 0
+    sample_width = 2
+    # reads that found input dropped, and writes that found the output
+    # had run dry
+    overflows = 0
+    underflows = 0
+
+    def read(self, n):
+        """
+        Returns the bytes of up to `n` frames, or b'' once the source is
+        exhausted.
+        """
+        raise NotImplementedError
+
+    def write(self, buf):
+        """
+        Queues a bytes-like buffer of whole frames for output.
+        """
+        raise NotImplementedError
+
+    def pending(self):
+        """
+        Frames of input waiting to be read.
+        """
+        return 0
+
+    def latency(self):
+        """
+        Latency this backend adds, in seconds.
+        """
+        return 0.0
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PyAudioBackend(Backend):
+    """
+    Blocking PyAudio streams on a sound card.
+    """
+
+    def __init__(self, rate, channels, sample_width=2, input=False, output=False,
+                 input_device=None, output_device=None, frames_per_buffer=1024):
+        import pyaudio
+
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.audio = pyaudio.PyAudio()
+        self.input_overflowed = pyaudio.paInputOverflowed
+        self.output_underflowed = pyaudio.paOutputUnderflowed
+        self.in_stream = None
+        self.out_stream = None
+
+        audio_format = self.audio.get_format_from_width(sample_width)
+        if input:
+            self.in_stream = self.audio.open(
+                format=audio_format,
+                channels=channels,
+                rate=rate,
+                input=True,
+                input_device_index=input_device,
+                frames_per_buffer=frames_per_buffer
+            )
+        if output:
+            self.out_stream = self.audio.open(
+                format=audio_format,
+                channels=channels,
+                rate=rate,
+                output=True,
+                output_device_index=output_device,
+                frames_per_buffer=frames_per_buffer
+            )
+
+    def read(self, n):
+        try:
+            return self.in_stream.read(n)
+        except IOError as e:
+            if e.errno != self.input_overflowed:
+                raise
+            # PyAudio drops the overflowed buffer, read a fresh one
+            self.overflows += 1
+            return self.in_stream.read(n, exception_on_overflow=False)
+
+    def write(self, buf):
+        # PyAudio only accepts bytes
+        if not isinstance(buf, bytes):
+            buf = bytes(memoryview(buf))
+        try:
+            self.out_stream.write(buf, exception_on_underflow=True)
+        except IOError as e:
+            # the frames are still written, the error only reports the gap
+            if e.errno != self.output_underflowed:
+                raise
+            self.underflows += 1
+
+    def pending(self):
+        if self.in_stream is None:
+            return 0
+        return self.in_stream.get_read_available()
+
+    def latency(self):
+        latency = 0.0
+        if self.in_stream is not None:
+            latency += self.in_stream.get_input_latency()
+        if self.out_stream is not None:
+            latency += self.out_stream.get_output_latency()
+        return latency
+
+    def close(self):
+        for stream in (self.in_stream, self.out_stream):
+            if stream is not None:
+                stream.stop_stream()
+                stream.close()
+        self.audio.terminate()
+
+
+class WavSource(Backend):
+    """
+    Reads frames from a wav file.
+    """
+
+    def __init__(self, filename):
+        self.wf = wave.open(filename, 'rb')
+        self.rate = self.wf.getframerate()
+        self.channels = self.wf.getnchannels()
+        self.sample_width = self.wf.getsampwidth()
+
+    def read(self, n):
+        return self.wf.readframes(n)
+
+    def close(self):
+        self.wf.close()
+
+
+class MappedWavSource(Backend):
+    """
+    Reads frames from a memory mapped wav file without copying them.
+
+    `read` returns a read-only memoryview of the mapped samples rather
+    than bytes, and `read_array` the same samples as an interleaved NumPy
+    view. Either is only valid until the source is closed.
+    """
+
+    def __init__(self, filename):
+        self.wav = MappedWav(filename)
+        self.rate = self.wav.rate
+        self.channels = self.wav.channels
+        self.sample_width = self.wav.sample_width
+
+    def read_array(self, n):
+        return self.wav.read(n).reshape(-1)
+
+    def read(self, n):
+        return memoryview(self.read_array(n)).cast('B')
+
+    def seek(self, frame):
+        self.wav.seek(frame)
+
+    def tell(self):
+        return self.wav.tell()
+
+    def close(self):
+        self.wav.close()
+
+
+class WavSink(Backend):
+    """
+    Writes frames to a wav file as they arrive.
+
+    The header is patched with the length so far and the file synced to
+    disk every `sync_secs` seconds of audio, and once more on close, so a
+    file cut off by a kill or power loss still reads as everything up to
+    the last sync.
+    """
+
+    # offsets of the RIFF and data sizes in the header the wave module
+    # writes for PCM
+    RIFF_SIZE = 4
+    DATA_SIZE = 40
+    HEADER = 44
+
+    def __init__(self, filename, rate, channels, sample_width=2, sync_secs=5.0):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_bytes = channels * sample_width
+        self.file = open(filename, 'wb')
+        self.wf = wave.open(self.file, 'wb')
+        self.wf.setnchannels(channels)
+        self.wf.setsampwidth(sample_width)
+        self.wf.setframerate(rate)
+        self.sync_frames = max(1, int(sync_secs * rate))
+        self.frames = 0
+        self.synced = 0
+
+    def write(self, buf):
+        self.wf.writeframesraw(buf)
+        self.frames += memoryview(buf).nbytes // self.frame_bytes
+        if self.frames - self.synced >= self.sync_frames:
+            self.sync()
+
+    def sync(self):
+        """
+        Patches the header with the frames written so far and flushes the
+        file to disk.
+        """
+        size = self.frames * self.frame_bytes
+        position = self.file.tell()
+        self.file.seek(self.RIFF_SIZE)
+        self.file.write(struct.pack('<I', self.HEADER - 8 + size))
+        self.file.seek(self.DATA_SIZE)
+        self.file.write(struct.pack('<I', size))
+        self.file.seek(position)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced = self.frames
+
+    def close(self):
+        # wave patches the header itself, but leaves a file it was given
+        # open
+        self.wf.close()
+        self.file.close()
+
+
+class SegmentedWavSink(Backend):
+    """
+    Writes frames to a series of wav files, starting a new one every
+    `segment_frames` frames.
+
+    A write that crosses a boundary is split between the two files, so no
+    frame is lost or repeated. Every segment gets a line in a tab
+    separated index file as it is opened, with its file name, the wall
+    clock time of its first frame and that frame's offset from the start
+    of the recording. The times are the start time plus the offset over
+    the sample rate, so they follow the sample clock. A range of time can
+    then be read by opening only the segments that cover it.
+
+    Parameters
+    ----------
+    filename : name the segment names are made from, 'capture.wav' gives
+        'capture_00000.wav', 'capture_00001.wav', ... and the index
+        'capture.index.tsv'
+    segment_frames : frames per segment
+    """
+
+    def __init__(self, filename, segment_frames, rate, channels, sample_width=2):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.segment_frames = segment_frames
+        self.frame_bytes = channels * sample_width
+        self.base, self.ext = os.path.splitext(filename)
+        self.ext = self.ext or '.wav'
+        self.index_path = self.base + '.index.tsv'
+        self.index = open(self.index_path, 'w')
+        self.index.write('file\tstart_time\tstart_frame\n')
+        self.start_time = time.time()
+        self.segment = -1
+        self.frames = 0
+        self.remaining = 0
+        self.sink = None
+
+    def _rotate(self):
+        if self.sink is not None:
+            self.sink.close()
+        self.segment += 1
+        filename = f"{self.base}_{self.segment:05d}{self.ext}"
+        self.sink = WavSink(filename, self.rate, self.channels, self.sample_width)
+        self.remaining = self.segment_frames
+        self.index.write(f"{os.path.basename(filename)}\t"
+                         f"{self.start_time + self.frames / self.rate:.6f}\t"
+                         f"{self.frames}\n")
+        # the index has to be readable while the recording is running
+        self.index.flush()
+
+    def write(self, buf):
+        buf = memoryview(buf).cast('B')
+        while len(buf) >= self.frame_bytes:
+            if self.remaining == 0:
+                self._rotate()
+            n = min(len(buf) // self.frame_bytes, self.remaining)
+            self.sink.write(buf[:n * self.frame_bytes])
+            buf = buf[n * self.frame_bytes:]
+            self.frames += n
+            self.remaining -= n
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+        self.index.close()
+
+
+class QueuedSink(Backend):
+    """
+    Hands writes to another sink on a writer thread, through a queue of
+    at most `maxsize` buffers.
+
+    The caller only waits for disk or network I/O once the queue is full,
+    and memory use is bounded by the queue whatever the length of the
+    stream. An error on the writer thread is raised by the next `write`
+    or by `close`.
+    """
+
+    def __init__(self, sink, maxsize=64):
+        self.sink = sink
+        self.rate = sink.rate
+        self.channels = sink.channels
+        self.sample_width = sink.sample_width
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            buf = self.queue.get()
+            if buf is None:
+                return
+            if self.error is None:
+                try:
+                    self.sink.write(buf)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, buf):
+        if self.error is not None:
+            raise self.error
+        # the buffer has to stay valid until the writer gets to it
+        if not isinstance(buf, bytes):
+            buf = bytes(memoryview(buf))
+        self.queue.put(buf)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+        if self.error is not None:
+            raise self.error
+
+
+def to_samples(values, sample_width):
+    """
+    Rounds and clips float samples to the integer type of `sample_width`.
+    """
+    dtype = SAMPLE_TYPES[sample_width]
+    info = np.iinfo(dtype)
+    np.rint(values, out=values)
+    np.clip(values, info.min, info.max, out=values)
+    return values.astype(dtype)
+
+
+class ResampledSource(Backend):
+    """
+    Reads another source at a different sample rate.
+
+    A read of `n` frames reads as many frames of the wrapped source as
+    give at most `n` frames once resampled, so the length of a read can
+    be a frame short of `n` when upsampling. The last few input frames
+    stay in the filter when the source runs out.
+    """
+
+    def __init__(self, source, rate, half_width=16):
+        self.source = source
+        self.rate = rate
+        self.channels = source.channels
+        self.sample_width = source.sample_width
+        self.dtype = SAMPLE_TYPES[source.sample_width]
+        self.resampler = Resampler(source.rate, rate, half_width)
+
+    @property
+    def overflows(self):
+        return self.source.overflows
+
+    def read(self, n):
+        m = max(1, self.resampler.input_frames(n))
+        frames = np.frombuffer(self.source.read(m), dtype=self.dtype)
+        if frames.size == 0:
+            return b''
+        out = self.resampler.process(frames.reshape(-1, self.channels))
+        return to_samples(out, self.sample_width).tobytes()
+
+    def pending(self):
+        return self.source.pending() * self.rate // self.source.rate
+
+    def latency(self):
+        return self.source.latency() + self.resampler.latency()
+
+    def close(self):
+        self.source.close()
+
+
+class ResampledSink(Backend):
+    """
+    Writes to another sink at a different sample rate.
+    """
+
+    def __init__(self, sink, rate, half_width=16):
+        self.sink = sink
+        self.rate = rate
+        self.channels = sink.channels
+        self.sample_width = sink.sample_width
+        self.dtype = SAMPLE_TYPES[sink.sample_width]
+        self.resampler = Resampler(rate, sink.rate, half_width)
+
+    @property
+    def underflows(self):
+        return self.sink.underflows
+
+    def write(self, buf):
+        frames = np.frombuffer(buf, dtype=self.dtype).reshape(-1, self.channels)
+        out = self.resampler.process(frames)
+        if out.shape[0] > 0:
+            self.sink.write(to_samples(out, self.sample_width))
+
+    def latency(self):
+        return self.sink.latency() + self.resampler.latency()
+
+    def close(self):
+        self.sink.close()
+
+
+class NullSink(Backend):
+    """
+    Discards everything written to it, counting the frames.
+    """
+
+    def __init__(self, rate, channels, sample_width=2):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frames = 0
+
+    def write(self, buf):
+        self.frames += memoryview(buf).nbytes // (self.channels * self.sample_width)
+
+
+class SignalSource(Backend):
+    """
+    Generates a sine tone or white noise, as fast as it is read.
+
+    Parameters
+    ----------
+    kind : 'sine' or 'noise'
+    frequency : frequency of the sine in Hz
+    amplitude : peak level, 0-1 of full scale
+    duration : length in seconds, or None to never run out
+    """
+
+    def __init__(self, kind, rate, channels, sample_width=2, frequency=440.0,
+                 amplitude=0.5, duration=None, seed=0):
+        if kind not in ('sine', 'noise'):
+            raise ValueError(f"Unknown signal {kind}")
+        self.kind = kind
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frequency = frequency
+        self.scale = amplitude * np.iinfo(SAMPLE_TYPES[sample_width]).max
+        self.remaining = None if duration is None else int(duration * rate)
+        self.position = 0
+        self.rng = np.random.default_rng(seed)
+
+    def read(self, n):
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+            self.remaining -= n
+        if self.kind == 'sine':
+            t = np.arange(self.position, self.position + n)
+            signal = np.sin(2 * np.pi * self.frequency / self.rate * t)
+        else:
+            signal = self.rng.uniform(-1, 1, n)
+        self.position += n
+        signal *= self.scale
+        frames = np.repeat(signal, self.channels)
+        return frames.astype(SAMPLE_TYPES[self.sample_width]).tobytes()
+
+
+def open_source(spec, rate, channels, sample_width=2, device=None,
+                frames_per_buffer=1024, duration=None):
+    """
+    Opens a source from a short description
+
+    Parameters
+    ----------
+    spec : 'mic' (or empty) for the sound card, 'sine[:<freq>]', 'noise',
+        or the path of a wav file, which is memory mapped if it is plain
+        PCM
+    rate, channels, sample_width : format of a sound card or generated
+        source, a wav file keeps its own
+    device : input device index for the sound card
+    duration : length of a generated source in seconds, None for endless
+
+    Returns
+    -------
+    Backend
+    """
+    kind, _, arg = (spec or 'mic').partition(':')
+    if kind == 'mic':
+        return PyAudioBackend(rate, channels, sample_width, input=True,
+                              input_device=device,
+                              frames_per_buffer=frames_per_buffer)
+    if kind == 'sine':
+        return SignalSource('sine', rate, channels, sample_width,
+                            frequency=float(arg or 440), duration=duration)
+    if kind == 'noise':
+        return SignalSource('noise', rate, channels, sample_width,
+                            duration=duration)
+    try:
+        return MappedWavSource(spec)
+    except ValueError:
+        return WavSource(spec)
+
+
+def open_sink(spec, rate, channels, sample_width=2, device=None,
+              frames_per_buffer=1024):
+    """
+    Opens a sink from a short description
+
+    Parameters
+    ----------
+    spec : 'speaker' (or empty) for the sound card, 'null', or the path
+        of a wav file to write
+    rate, channels, sample_width : format of the output
+    device : output device index for the sound card
+
+    Returns
+    -------
+    Backend
+    """
+    spec = spec or 'speaker'
+    if spec == 'speaker':
+        return PyAudioBackend(rate, channels, sample_width, output=True,
+                              output_device=device,
+                              frames_per_buffer=frames_per_buffer)
+    if spec == 'null':
+        return NullSink(rate, channels, sample_width)
+    return WavSink(spec, rate, channels, sample_width)
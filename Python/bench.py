@@ -0,0 +1,315 @@
+"""
+    bench.py - Per chunk timing of every statsplay effect stage
+
+    Runs without an audio device. Each stage is timed on the same random
+    input for every call, for every chunk size and sample rate, and
+    reported as a share of the real time budget of one chunk (chunk / rate
+    seconds).
+"""
+
+import getopt
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from dsp import LFO, Resampler
+from effects import (BufferArena, ClipDistort, Convolution, Delay, Dynamics,
+                     Filter, Flanger, Reverb, StereoOutput, TanhDistort,
+                     Tremolo)
+from statsplay import load_filter, subsample
+
+help_str = "bench.py - effect stage micro benchmarks\nUsage:\n\t-h\t\thelp\n\t[-o]\t<file>\tsave results as json\n\t[-c]\t<file>\tcompare against saved results\n\t[-t]\t<pct>\tslowdown reported as a regression [default: 10]\n\t[-n]\t<num>\ttimed runs per case, best is kept [default: 5]"
+
+CHUNKS = [256, 512, 1024, 2048, 4096, 8192]
+RATES = [16000, 44100, 48000]
+
+DEFAULT_PARAMS = {
+    'volume': 10000,
+    'filter_enabled': False,
+    'fade': 0.5,
+    'pan_rate': 0.0,
+    'pan_depth': 1.0,
+    'pan_shape': 'sine',
+    'tremolo_rate': 0.0,
+    'tremolo_depth': 0.5,
+    'tremolo_shape': 'sine',
+    'flanger_mix': 0.0,
+    'flanger_rate': 0.25,
+    'flanger_shape': 'sine',
+    'flanger_min_secs': 0.04,
+    'flanger_max_secs': 0.08,
+    'flanger_feedback': 0.0,
+    'convolution_mix': 0.3,
+    'compressor_threshold': 0.1,
+    'compressor_ratio': np.inf,
+    'compressor_attack': 0.005,
+    'compressor_release': 0.25,
+    'clip_distort': 0.0,
+    'tanh_distort': 0.0,
+    'delay_secs': 0,
+    'delay_amplitude': 0.5,
+    'reverb_secs': 0,
+    'reverb_falloff': 0.5,
+    'reverb_amplitude': 0.5,
+}
+
+
+def stage_case(stage, **params):
+    """
+    Prepares an effect stage and returns a function that runs it on one
+    block with the given parameters.
+    """
+    values = dict(DEFAULT_PARAMS, **params)
+
+    def setup(chunk, rate, block):
+        stage.prepare(chunk, rate)
+        return lambda: stage.process(block, values)
+    return setup
+
+
+def output_case(fade, pan_rate=0.0):
+    values = dict(DEFAULT_PARAMS, fade=fade, pan_rate=pan_rate)
+
+    def setup(chunk, rate, block):
+        output = StereoOutput(BufferArena(chunk, 2), rate)
+        return lambda: output.process(block, values)
+    return setup
+
+
+def peak_case():
+    """
+    The per-chunk peak the old auto gain was driven by, as a yardstick
+    for the compressor.
+    """
+    def setup(chunk, rate, block):
+        magnitude = np.empty(chunk)
+        return lambda: magnitude[np.abs(block, out=magnitude).argmax()]
+    return setup
+
+
+def fadefunc_case(setup_rate):
+    """
+    The per-sample sine the fade used to be computed with, as a yardstick
+    for the LFO.
+    """
+    def setup(chunk, rate, block):
+        count = np.arange(chunk)
+        return lambda: (np.sin(setup_rate * count * np.pi / rate) + 1) / 2
+    return setup
+
+
+def lfo_case(shape):
+    def setup(chunk, rate, block):
+        lfo = LFO(shape, 1.0, rate)
+        return lambda: lfo.block(chunk)
+    return setup
+
+
+def resample_case(to_rate, channels=2):
+    """
+    Converting a stereo chunk from the bench rate to `to_rate`.
+    """
+    def setup(chunk, rate, block):
+        resampler = Resampler(rate, to_rate)
+        frames = np.repeat(block, channels).reshape(-1, channels)
+        return lambda: resampler.process(frames)
+    return setup
+
+
+def convolution_case(secs):
+    """
+    The convolution reverb with `secs` of decaying noise as the room.
+    """
+    def setup(chunk, rate, block):
+        t = np.arange(int(secs * rate)) / rate
+        response = np.random.default_rng(0).standard_normal(t.size) * np.exp(-3 * t / secs)
+        return stage_case(Convolution(response / np.sqrt(np.sum(response ** 2))))(
+            chunk, rate, block)
+    return setup
+
+
+def subsample_case(factor, method):
+    def setup(chunk, rate, block):
+        return lambda: subsample(block, factor, method)
+    return setup
+
+
+# (stage, setting, setup) for every case, setups are called once per
+# chunk size and rate with a fresh block of input
+CASES = [
+    ('peak', 'abs,argmax', peak_case),
+    ('filter', 'equiripple56', lambda: stage_case(Filter(load_filter()))),
+    ('filter', 'taps=2048', lambda: stage_case(
+        Filter(np.random.default_rng(0).uniform(-1, 1, 2048) / 2048))),
+    ('compressor', 'limit,attack=0', lambda: stage_case(Dynamics(), compressor_attack=0)),
+    ('compressor', 'limit,attack=0.005', lambda: stage_case(Dynamics())),
+    ('compressor', 'ratio=4,attack=0.005', lambda: stage_case(Dynamics(), compressor_ratio=4)),
+    ('clip_distort', 'ratio=0.5', lambda: stage_case(ClipDistort(), clip_distort=0.5)),
+    ('clip_distort', 'ratio=5', lambda: stage_case(ClipDistort(), clip_distort=5)),
+    ('tanh_distort', 'ratio=0.5', lambda: stage_case(TanhDistort(), tanh_distort=0.5)),
+    ('fadefunc', 'rate=2', lambda: fadefunc_case(2)),
+    ('lfo', 'sine', lambda: lfo_case('sine')),
+    ('lfo', 'square', lambda: lfo_case('square')),
+    ('tremolo', 'rate=5', lambda: stage_case(Tremolo(), tremolo_rate=5)),
+    ('subsample', 'factor=16,mean', lambda: subsample_case(16, 'mean')),
+    ('subsample', 'factor=16,median', lambda: subsample_case(16, 'median')),
+    ('delay', 'secs=0.01', lambda: stage_case(Delay(), delay_secs=0.01)),
+    ('delay', 'secs=1', lambda: stage_case(Delay(), delay_secs=1)),
+    ('flanger', '40-80ms', lambda: stage_case(Flanger(), flanger_mix=0.5)),
+    ('flanger', '1-5ms,fb=0.7', lambda: stage_case(
+        Flanger(), flanger_mix=0.5, flanger_min_secs=0.001, flanger_max_secs=0.005,
+        flanger_feedback=0.7)),
+    ('reverb', 'secs=0.01', lambda: stage_case(Reverb(), reverb_secs=0.01)),
+    ('reverb', 'secs=0.5', lambda: stage_case(Reverb(), reverb_secs=0.5)),
+    ('resample', 'to=16000', lambda: resample_case(16000)),
+    ('resample', 'to=44100', lambda: resample_case(44100)),
+    ('resample', 'to=48000', lambda: resample_case(48000)),
+    ('convolution', 'secs=1', lambda: convolution_case(1)),
+    ('convolution', 'secs=3', lambda: convolution_case(3)),
+    ('interleave', 'fade=0.5', lambda: output_case(0.5)),
+    ('interleave', 'fade=0.3', lambda: output_case(0.3)),
+    ('interleave', 'pan=0.5', lambda: output_case(0.5, pan_rate=0.5)),
+]
+
+
+def time_case(func, repeat):
+    """
+    Best time per call, with the number of calls per run picked so a run
+    takes about a tenth of a second.
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * 0.1 / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(repeat=5):
+    """
+    Times every case for every chunk size and rate.
+
+    Returns
+    -------
+    list of result dictionaries
+    """
+    rng = np.random.default_rng(0)
+    results = []
+    for stage, setting, make in CASES:
+        for rate in RATES:
+            for chunk in CHUNKS:
+                # the stages work in place, so every call gets a fresh copy
+                # of the input, or most runs would time silence, denormals
+                # or overflowed values. The copy is timed and taken off.
+                source = rng.uniform(-1, 1, chunk)
+                block = source.copy()
+                func = make()(chunk, rate, block)
+
+                def fresh():
+                    np.copyto(block, source)
+                    func()
+
+                budget = chunk / rate
+                copy = time_case(lambda: np.copyto(block, source), repeat)
+                seconds = max(time_case(fresh, repeat) - copy, 0.0)
+                results.append({
+                    'stage': stage,
+                    'setting': setting,
+                    'chunk': chunk,
+                    'rate': rate,
+                    'seconds': seconds,
+                    'budget_pct': 100 * seconds / budget,
+                })
+                print(f"{stage:>12} {setting:>18} {rate:>6} Hz {chunk:>5} "
+                      f"{seconds * 1e6:10.1f} us {results[-1]['budget_pct']:8.3f} %")
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every case against a baseline run.
+
+    Returns
+    -------
+    number of cases slower than the baseline by more than `threshold` percent
+    """
+    key = lambda r: (r['stage'], r['setting'], r['rate'], r['chunk'])
+    old = {key(r): r for r in baseline['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline['meta'].get('commit')}:")
+    for result in results:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        name = (f"{result['stage']:>12} {result['setting']:>18} "
+                f"{result['rate']:>6} Hz {result['chunk']:>5}")
+        # a case faster than the copy it is timed with clamps to 0
+        if before['seconds'] == 0:
+            print(f"{name}      n/a    no baseline time")
+            continue
+        change = 100 * (result['seconds'] / before['seconds'] - 1)
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{name} {change:+8.1f} %{flag}")
+    print(f"{regressions} regressions over {threshold} %")
+    return regressions
+
+
+def main(argv):
+    output = ''
+    baseline = ''
+    threshold = 10.0
+    repeat = 5
+    try:
+        opts, args = getopt.getopt(argv, "ho:c:t:n:")
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_str)
+            sys.exit(0)
+        elif opt == '-o':
+            output = arg
+        elif opt == '-c':
+            baseline = arg
+        elif opt == '-t':
+            threshold = float(arg)
+        elif opt == '-n':
+            repeat = int(arg)
+
+    results = run(repeat)
+
+    if output != '':
+        with open(output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, indent=1)
+
+    if baseline != '':
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,1005 @@
+"""
+    dsp.py - Block based audio effect engines
+"""
+
+import functools
+import math
+
+import numpy as np
+
+
+class DelayLine:
+    """
+    Circular delay line that processes a whole chunk at a time.
+
+    Produces exactly the same samples as the per-sample `delayline` loop
+    it replaces: each input is stored at the read pointer after the old
+    value is read out, and the pointer wraps at the current delay length.
+    """
+
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity)
+        self.ptr = 0
+        self._out = np.empty(0)
+        self._mix = np.empty(0)
+
+    def _scratch(self, n):
+        """
+        Returns the output and mixing buffers for an `n` sample block,
+        only allocating when a longer block than before comes through.
+        """
+        if self._out.size < n:
+            self._out = np.empty(n)
+            self._mix = np.empty(n)
+        if self._out.size == n:
+            return self._out, self._mix
+        return self._out[:n], self._mix[:n]
+
+    def _mix_into(self, block, y, amplitude):
+        """
+        block += amplitude * y + (1 - amplitude) * block, without
+        temporaries. Uses `y` as scratch space.
+        """
+        mix = self._mix if self._mix.size == block.size \
+            else self._mix[:block.size]
+        np.multiply(y, amplitude, out=y)
+        np.multiply(block, 1 - amplitude, out=mix)
+        y += mix
+        block += y
+
+    def _read(self, out, length):
+        """
+        Copy `out.size` samples starting at the read pointer into `out`,
+        wrapping at `length`.
+        """
+        n = out.size
+        first = min(n, length - self.ptr)
+        out[:first] = self.buffer[self.ptr:self.ptr + first]
+        out[first:] = self.buffer[:n - first]
+
+    def _write(self, values, start, length):
+        """
+        Store `values` starting at `start`, wrapping at `length`.
+        """
+        n = values.size
+        first = min(n, length - start)
+        self.buffer[start:start + first] = values[:first]
+        self.buffer[:n - first] = values[first:]
+
+    def _step(self, x, length):
+        """
+        Single sample update, used when the pointer is left outside a
+        shortened delay.
+        """
+        y = self.buffer[self.ptr]
+        self.buffer[self.ptr] = x
+        self.ptr = (self.ptr + 1) % length
+        return y
+
+    def delayed(self, block, length):
+        """
+        Push a block through the delay line.
+
+        Parameters
+        ----------
+        block : ndarray of input samples
+        length : delay in samples, at most the buffer capacity
+
+        Returns
+        -------
+        ndarray of the samples that come out of the delay line, valid
+        until the next call
+        """
+        n = block.size
+        y, _ = self._scratch(n)
+        if n == 0:
+            return y
+
+        start = 0
+        if self.ptr >= length:
+            # the delay was shortened under the pointer, step once to
+            # bring it back into range the same way the old loop did
+            y[0] = self._step(block[0], length)
+            start = 1
+
+        x = block[start:]
+        out = y[start:]
+        k = min(x.size, length)
+
+        # the first `length` outputs were stored by earlier chunks,
+        # everything after that comes straight from this chunk
+        self._read(out[:k], length)
+        out[k:] = x[:x.size - k]
+
+        # only the last `length` inputs survive in the buffer
+        self._write(x[x.size - k:], (self.ptr + x.size - k) % length, length)
+        self.ptr = (self.ptr + x.size) % length
+        return y
+
+    def process(self, block, length, amplitude):
+        """
+        Mix the delayed signal into `block` in place.
+
+        Parameters
+        ----------
+        block : ndarray of samples, modified in place
+        length : delay in samples
+        amplitude : mix of the delayed signal, 0-1
+        """
+        y = self.delayed(block, length)
+        self._mix_into(block, y, amplitude)
+
+
+class CombFilter(DelayLine):
+    """
+    Feedback comb filter that processes a whole chunk at a time.
+
+    Each stored sample is the input plus `feedback` times the sample that
+    was read out of the same slot, as in the per-sample `reverbline` loop.
+    Because of the feedback a slot can only be updated once per pass, so
+    chunks longer than the delay are run as consecutive sub-blocks of at
+    most one delay length, each of which is a plain vectorized update.
+    """
+
+    def _step(self, x, length, feedback=0):
+        y = self.buffer[self.ptr]
+        self.buffer[self.ptr] = x + feedback * y
+        self.ptr = (self.ptr + 1) % length
+        return y
+
+    def recirculated(self, block, length, feedback):
+        """
+        Push a block through the comb filter.
+
+        Parameters
+        ----------
+        block : ndarray of input samples
+        length : delay in samples, at most the buffer capacity
+        feedback : gain applied to the recirculated signal
+
+        Returns
+        -------
+        ndarray of the samples that come out of the comb filter, valid
+        until the next call
+        """
+        n = block.size
+        y, mix = self._scratch(n)
+        if n == 0:
+            return y
+
+        start = 0
+        if self.ptr >= length:
+            y[0] = self._step(block[0], length, feedback)
+            start = 1
+
+        while start < n:
+            stop = min(n, start + length)
+            x = block[start:stop]
+            out = y[start:stop]
+            stored = mix[:x.size]
+            self._read(out, length)
+            np.multiply(out, feedback, out=stored)
+            stored += x
+            self._write(stored, self.ptr, length)
+            self.ptr = (self.ptr + x.size) % length
+            start = stop
+        return y
+
+    def process(self, block, length, feedback, amplitude):
+        """
+        Mix the comb filter output into `block` in place.
+
+        Parameters
+        ----------
+        block : ndarray of samples, modified in place
+        length : delay in samples
+        feedback : gain applied to the recirculated signal
+        amplitude : mix of the comb filter output, 0-1
+        """
+        y = self.recirculated(block, length, feedback)
+        self._mix_into(block, y, amplitude)
+
+
+def sliding_max(values, width, out, scratch=None):
+    """
+    Maximum of every `width` long window of `values`.
+
+    Doubles the span of a running maximum until it covers half the window
+    and combines two overlapping spans, so the cost grows with the log of
+    the width and every pass is a plain vectorized maximum.
+
+    Parameters
+    ----------
+    values : ndarray of at least `width` samples
+    width : window length
+    out : ndarray of values.size - width + 1 samples to write into,
+        out[i] is the maximum of values[i:i + width]
+    scratch : optional ndarray of at least 2 * values.size samples, to
+        avoid allocating
+
+    Returns
+    -------
+    out
+    """
+    m = values.size
+    if scratch is None:
+        scratch = np.empty(2 * m)
+    a = scratch[:m]
+    b = scratch[m:2 * m]
+    np.copyto(a, values)
+    # a[i] is the maximum of values[i:i + span] for i < valid
+    span = 1
+    valid = m
+    while 2 * span <= width:
+        np.maximum(a[:valid - span], a[span:valid], out=b[:valid - span])
+        a, b = b, a
+        valid -= span
+        span *= 2
+    np.maximum(a[:out.size], a[width - span:width - span + out.size], out=out)
+    return out
+
+
+class Compressor:
+    """
+    Look-ahead compressor/limiter with a sample accurate gain envelope.
+
+    The level is the peak of the last `lookahead` + 1 input samples,
+    followed by an exponential release. Above the threshold the gain
+    follows the compression ratio, and is then averaged over the same
+    look-ahead window. The signal itself is delayed by the look-ahead, so
+    the gain has finished ramping down by the time a peak reaches the
+    output and a limiter never overshoots its threshold.
+
+    Every step works on the whole block. The release recursion
+    env[t] = max(level[t], r * env[t-1]) is solved as a running maximum
+    of level[t] * r ** -t, scaled back by r ** t.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def _resize(self, n, lookahead):
+        """
+        Sizes the history and scratch buffers for `n` sample blocks. A
+        longer block keeps the look-ahead history, a new look-ahead starts
+        from silence at the current gain.
+        """
+        if lookahead == self.lookahead and self.hold.size >= n:
+            return
+        size = n + lookahead
+        signal = np.zeros(size)
+        levels = np.zeros(size)
+        gains = np.full(size, self.gain)
+        if lookahead == self.lookahead:
+            signal[:lookahead] = self.signal[:lookahead]
+            levels[:lookahead] = self.levels[:lookahead]
+            gains[:lookahead] = self.gains[:lookahead]
+        self.signal = signal
+        self.levels = levels
+        self.gains = gains
+        self.sums = np.zeros(size + 1)
+        self.hold = np.zeros(n)
+        self.scratch = np.empty(2 * size)
+        self.index = np.arange(n, dtype=float)
+        self.grow = np.empty(n)
+        self.decay = np.empty(n)
+        self.release = None
+        self.lookahead = lookahead
+
+    def _ramps(self, release):
+        """
+        Caches r ** -t and r ** t for the release factor r.
+        """
+        # r ** -n has to stay well inside the float range
+        release = max(release, self.index.size / 600, 1)
+        if release != self.release:
+            np.multiply(self.index, 1 / release, out=self.grow)
+            np.exp(self.grow, out=self.grow)
+            np.reciprocal(self.grow, out=self.decay)
+            self.r = np.exp(-1 / release)
+            self.release = release
+
+    def process(self, block, threshold, ratio, lookahead, release, makeup=1.0):
+        """
+        Compress `block` in place.
+
+        Parameters
+        ----------
+        block : ndarray of samples, modified in place
+        threshold : level above which the gain is reduced, 0-1
+        ratio : compression ratio, np.inf for a limiter
+        lookahead : look-ahead and attack time in samples
+        release : time constant of the release in samples
+        makeup : gain applied on top of the compression
+
+        Returns
+        -------
+        ndarray of the gain applied to each sample, valid until the next
+        call
+        """
+        n = block.size
+        if n == 0:
+            return block
+        self._resize(n, lookahead)
+        self._ramps(release)
+        m = n + lookahead
+        signal = self.signal[:m]
+        levels = self.levels[:m]
+        gains = self.gains[:m]
+        hold = self.hold[:n]
+
+        # the first `lookahead` samples of the history buffers are the
+        # end of the previous block
+        np.abs(block, out=levels[lookahead:])
+        sliding_max(levels, lookahead + 1, hold, self.scratch)
+
+        # running maximum of level[t] * r ** -t, seeded with the envelope
+        # left over from the previous block
+        hold *= self.grow[:n]
+        hold[0] = max(hold[0], self.env * self.r)
+        np.maximum.accumulate(hold, out=hold)
+        hold *= self.decay[:n]
+        self.env = hold[-1]
+
+        # gain = (env / threshold) ** (1 / ratio - 1) above the threshold
+        g = gains[lookahead:]
+        np.maximum(hold, threshold, out=hold)
+        if np.isinf(ratio):
+            np.divide(threshold * makeup, hold, out=g)
+        else:
+            hold *= 1 / threshold
+            np.power(hold, 1 / ratio - 1, out=g)
+            if makeup != 1:
+                g *= makeup
+        self.gain = g[-1]
+
+        # average the gain over the look-ahead window
+        smoothed = hold
+        if lookahead > 0:
+            sums = self.sums[:m + 1]
+            np.cumsum(gains, out=sums[1:])
+            np.subtract(sums[lookahead + 1:], sums[:n], out=smoothed)
+            smoothed *= 1 / (lookahead + 1)
+            signal[lookahead:] = block
+            block[:] = signal[:n]
+            signal[:lookahead] = signal[n:]
+            levels[:lookahead] = levels[n:]
+            gains[:lookahead] = gains[n:]
+        else:
+            np.copyto(smoothed, g)
+        block *= smoothed
+        return smoothed
+
+    def reset(self):
+        """
+        Clears the envelope, history and delay.
+        """
+        self.lookahead = -1
+        self.env = 0.0
+        self.gain = 1.0
+        self.hold = np.zeros(0)
+
+
+@functools.lru_cache(maxsize=None)
+def wavetable(shape, size=4096):
+    """
+    One cycle of a unipolar, 0-1 waveform, computed once per shape and
+    size.
+
+    Parameters
+    ----------
+    shape : 'sine', 'triangle' or 'square'
+    size : number of entries, a power of two
+
+    Returns
+    -------
+    read-only ndarray of `size` values, starting at the middle of the
+    range and rising for the sine and triangle
+    """
+    x = np.arange(size) / size
+    if shape == 'sine':
+        table = (np.sin(2 * np.pi * x) + 1) / 2
+    elif shape == 'triangle':
+        table = 1 - np.abs(((x + 0.25) % 1) * 2 - 1)
+    elif shape == 'square':
+        table = (x < 0.5).astype(float)
+    else:
+        raise ValueError(f"Unknown LFO shape {shape}")
+    table.flags.writeable = False
+    return table
+
+
+class LFO:
+    """
+    Phase accumulator low frequency oscillator reading a cached wavetable.
+
+    The phase is kept in cycles and wrapped after every block, so it
+    doesn't lose precision however long it runs. A block of values is one
+    vectorized table lookup, at the entry below, with no transcendental
+    functions per sample.
+
+    Parameters
+    ----------
+    shape : 'sine', 'triangle' or 'square'
+    rate : frequency in Hz, can be changed between blocks
+    framerate : sample rate in Hz
+    size : wavetable length, a power of two
+    phase : starting phase in cycles
+    """
+
+    def __init__(self, shape='sine', rate=1.0, framerate=44100, size=4096,
+                 phase=0.0):
+        if size & (size - 1):
+            raise ValueError("The wavetable size has to be a power of two")
+        self.shape = shape
+        self.rate = rate
+        self.framerate = framerate
+        self.size = size
+        self.phase = phase % 1
+        self._step = None
+        self._count = np.zeros(0)
+        self._ramp = np.zeros(0)
+        self._position = np.zeros(0)
+        self._index = np.zeros(0, dtype=np.intp)
+        self._out = np.zeros(0)
+
+    def _prepare(self, n):
+        """
+        Sizes the scratch buffers and caches the table positions of the
+        first `n` samples of a block for the current rate.
+        """
+        step = self.rate / self.framerate * self.size
+        if self._ramp.size < n:
+            self._count = np.arange(n, dtype=float)
+            self._ramp = np.empty(n)
+            self._position = np.empty(n)
+            self._index = np.empty(n, dtype=np.intp)
+            self._out = np.empty(n)
+            self._step = None
+        if step != self._step:
+            np.multiply(self._count, step, out=self._ramp)
+            self._step = step
+
+    def block(self, n):
+        """
+        Returns the next `n` values, 0-1, valid until the next call.
+        """
+        self._prepare(n)
+        table = wavetable(self.shape, self.size)
+        if n == self._out.size:
+            ramp, position, index, out = self._ramp, self._position, self._index, self._out
+        else:
+            ramp, position, index, out = (self._ramp[:n], self._position[:n],
+                                          self._index[:n], self._out[:n])
+
+        np.add(ramp, self.phase * self.size, out=position)
+        # truncate to the entry below and let take wrap into the table
+        np.copyto(index, position, casting='unsafe')
+        np.take(table, index, out=out, mode='wrap')
+
+        self.phase = (self.phase + n * self.rate / self.framerate) % 1
+        return out
+
+
+class ModulatedDelay:
+    """
+    Delay line with a per sample, fractional delay time, the core of a
+    flanger or chorus.
+
+    The read positions of a whole block are computed at once and the
+    delayed samples gathered from the circular buffer with linear
+    interpolation between the two neighbouring samples. Without feedback
+    the block is stored first and read back in one pass. With feedback
+    each stored sample depends on an earlier output, so the block is run
+    in sub-blocks shorter than the smallest delay, as in CombFilter.
+
+    Parameters
+    ----------
+    capacity : longest delay in samples
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(0)
+        self.size = 0
+        # index the next sample is stored at
+        self.ptr = 0
+        self.chunk = 0
+
+    def _prepare(self, n):
+        """
+        Sizes the buffer to hold the longest delay plus an `n` sample
+        block, and the scratch space for `n` samples.
+        """
+        if n <= self.chunk:
+            return
+        size = 1
+        while size < self.capacity + n + 2:
+            size *= 2
+        if size > self.size:
+            # keep the history, oldest sample first
+            buffer = np.zeros(size)
+            buffer[:self.size] = np.roll(self.buffer, -self.ptr)
+            self.buffer = buffer
+            self.ptr = self.size
+            self.size = size
+        self.chunk = n
+        self._count = np.arange(n, dtype=float)
+        self._position = np.empty(n)
+        self._index = np.empty(n, dtype=np.intp)
+        self._frac = np.empty(n)
+        self._next = np.empty(n)
+        self._out = np.empty(n)
+
+    def _write(self, values):
+        n = values.size
+        first = min(n, self.size - self.ptr)
+        self.buffer[self.ptr:self.ptr + first] = values[:first]
+        self.buffer[:n - first] = values[first:]
+
+    def _read(self, delays, start, out):
+        """
+        Interpolated samples `delays` behind the positions start,
+        start + 1, ... of the buffer, into `out`.
+        """
+        n = delays.size
+        position = self._position[:n]
+        index = self._index[:n]
+        frac = self._frac[:n]
+        following = self._next[:n]
+
+        np.add(self._count[:n], start, out=position)
+        position -= delays
+        np.floor(position, out=frac)
+        np.copyto(index, frac, casting='unsafe')
+        np.subtract(position, frac, out=frac)
+
+        # take wraps negative and overrunning positions into the buffer
+        np.take(self.buffer, index, out=out, mode='wrap')
+        index += 1
+        np.take(self.buffer, index, out=following, mode='wrap')
+        following -= out
+        following *= frac
+        out += following
+        return out
+
+    def delayed(self, block, delays, feedback=0.0):
+        """
+        Push a block through the delay line.
+
+        Parameters
+        ----------
+        block : ndarray of input samples
+        delays : ndarray of the delay of every sample, at least 2 and at
+            most the capacity
+        feedback : gain of the delayed signal fed back into the line
+
+        Returns
+        -------
+        ndarray of the delayed samples, valid until the next call
+        """
+        n = block.size
+        self._prepare(n)
+        y = self._out[:n]
+        if n == 0:
+            return y
+
+        if feedback == 0:
+            start = self.ptr
+            self._write(block)
+            self._read(delays, start, y)
+            self.ptr = (self.ptr + n) % self.size
+            return y
+
+        # a sample can only be read once the sub-block before has stored it
+        step = max(1, int(delays.min()) - 1)
+        for i in range(0, n, step):
+            j = min(n, i + step)
+            out = self._read(delays[i:j], self.ptr, y[i:j])
+            stored = self._frac[:j - i]
+            np.multiply(out, feedback, out=stored)
+            stored += block[i:j]
+            self._write(stored)
+            self.ptr = (self.ptr + j - i) % self.size
+        return y
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(up, down, half_width=16, beta=8.6):
+    """
+    Kaiser windowed sinc low-pass for resampling by `up` / `down`, split
+    into its `up` polyphase branches, computed once per rate pair.
+
+    The cutoff is 0.9 of the Nyquist frequency of the lower of the two
+    rates, and the filter spans `half_width` of its periods on each side.
+
+    Returns
+    -------
+    read-only (up, taps) ndarray, branch `p` holding taps p, p + up,
+    p + 2 * up, ... of the prototype in reverse, so a branch is applied to
+    a window of the input oldest sample first
+    """
+    factor = max(up, down)
+    length = 2 * half_width * factor + 1
+    taps = -(-length // up)
+    cutoff = 0.9 * 0.5 / factor
+
+    t = np.arange(length) - (length - 1) / 2
+    prototype = np.zeros(taps * up)
+    prototype[:length] = up * 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, beta)
+
+    branches = np.ascontiguousarray(prototype.reshape(taps, up).T[:, ::-1])
+    branches.flags.writeable = False
+    return branches
+
+
+class Resampler:
+    """
+    Streaming polyphase sample rate converter.
+
+    The rates are reduced to the smallest `up` / `down` ratio and only
+    the filter branch each output sample needs is evaluated, as if the
+    input were upsampled by `up`, low-pass filtered and downsampled by
+    `down`. The last inputs of every block are kept, so blocks of any
+    size join up without clicks, and a block is one gather and one
+    multiply-add over all of its output samples.
+
+    Parameters
+    ----------
+    from_rate, to_rate : sample rates in Hz
+    half_width : filter length on each side, in periods of the lower rate
+    """
+
+    def __init__(self, from_rate, to_rate, half_width=16):
+        divisor = math.gcd(from_rate, to_rate)
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.up = to_rate // divisor
+        self.down = from_rate // divisor
+        self.filters = polyphase_filter(self.up, self.down, half_width)
+        self.taps = self.filters.shape[1]
+        self.length = 2 * half_width * max(self.up, self.down) + 1
+        self.history = self.taps - 1
+        self.chunk = 0
+        self.shape = None
+        self.reset()
+
+    def reset(self):
+        # position of the next output, in input samples times `up`, from
+        # the start of the buffer. The history starts out silent.
+        self.position = self.history * self.up
+
+    def latency(self):
+        """
+        Delay of the filter in seconds.
+        """
+        return (self.length - 1) / 2 / self.up / self.from_rate
+
+    def input_frames(self, n):
+        """
+        Most input frames that give no more than `n` output frames.
+        """
+        return max(0, (n * self.down + self.position) // self.up - self.history)
+
+    def output_frames(self, n):
+        """
+        Number of output frames the next `n` input frames give.
+        """
+        return max(0, -(-((self.history + n) * self.up - self.position) // self.down))
+
+    def _prepare(self, n, shape):
+        if n <= self.chunk and shape == self.shape:
+            return
+        buffer = np.zeros((self.history + n, int(np.prod(shape))))
+        if shape == self.shape:
+            buffer[:self.history] = self.buffer[:self.history]
+        self.buffer = buffer
+        self.shape = shape
+        self.chunk = n
+        self._steps = self.down * np.arange(self.output_frames(n) + 1)
+
+    def process(self, block):
+        """
+        Resamples a block of samples.
+
+        Parameters
+        ----------
+        block : (frames,) or (frames, channels) ndarray
+
+        Returns
+        -------
+        ndarray of the resampled frames, the shape of `block` apart from
+        the length
+        """
+        n = block.shape[0]
+        shape = block.shape[1:]
+        if n == 0:
+            return np.zeros((0,) + shape)
+        self._prepare(n, shape)
+        end = self.history + n
+        self.buffer[self.history:end] = block.reshape(n, -1)
+
+        count = self.output_frames(n)
+        base, phase = np.divmod(self.position + self._steps[:count], self.up)
+        # (count, channels, taps) windows times (count, taps, 1) branches
+        windows = np.lib.stride_tricks.sliding_window_view(
+            self.buffer[:end], self.taps, axis=0)[base - self.history]
+        out = np.matmul(windows, self.filters[phase][:, :, None])
+
+        self.position += count * self.down - n * self.up
+        self.buffer[:self.history] = self.buffer[n:end]
+        return out.reshape((count,) + shape)
+
+
+@functools.lru_cache(maxsize=None)
+def load_coefficients(path, row=0):
+    """
+    Reads FIR filter coefficients from a file, once per file.
+
+    Parameters
+    ----------
+    path : .mat file as saved by MATLAB's filterDesigner, using the 'Num'
+        variable or else the first one in the file, a .npy file, or a text
+        file of numbers separated by whitespace or commas
+    row : row to use when the file holds several filters
+
+    Returns
+    -------
+    read-only 1D ndarray of coefficients
+    """
+    if path.endswith('.mat'):
+        from scipy.io import loadmat
+
+        variables = {name: value for name, value in loadmat(path).items()
+                     if not name.startswith('__')}
+        if not variables:
+            raise ValueError(f"No coefficients in {path}")
+        coefficients = variables.get('Num', next(iter(variables.values())))
+    elif path.endswith('.npy'):
+        coefficients = np.load(path)
+    else:
+        with open(path) as f:
+            coefficients = np.loadtxt(f.read().replace(',', ' ').splitlines(), ndmin=2)
+
+    coefficients = np.atleast_2d(np.asarray(coefficients, dtype=float))
+    if coefficients.shape[0] == 1 or coefficients.shape[1] == 1:
+        coefficients = coefficients.reshape(1, -1)
+    coefficients = np.ascontiguousarray(coefficients[row])
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+def _fft_takes_out():
+    try:
+        np.fft.rfft(np.zeros(2), out=np.empty(2, dtype=complex))
+    except TypeError:
+        return False
+    return True
+
+
+# NumPy 1 has no out= on its FFTs, there they allocate and are copied
+FFT_OUT = _fft_takes_out()
+
+
+def rfft(values, out):
+    """
+    np.fft.rfft of `values` written into `out`.
+    """
+    if FFT_OUT:
+        return np.fft.rfft(values, out=out)
+    out[:] = np.fft.rfft(values)
+    return out
+
+
+def irfft(spectrum, n, out):
+    """
+    np.fft.irfft of `spectrum` to `n` points written into `out`.
+    """
+    if FFT_OUT:
+        return np.fft.irfft(spectrum, n, out=out)
+    out[:] = np.fft.irfft(spectrum, n)
+    return out
+
+
+class FIRFilter:
+    """
+    Streaming FIR filter.
+
+    The last taps - 1 inputs are kept between blocks, so the output is the
+    same however the signal is split. Blocks are filtered, with the plan
+    for the longest block so far, either in direct form, as one
+    matrix-vector product over a sliding window view, or by FFT
+    overlap-save, whichever the cost estimate says is cheaper: direct form
+    costs taps multiply-adds per sample, overlap-save two real FFTs a block
+    whatever the number of taps. Both write into buffers allocated once
+    per block size, except for the FFTs on NumPy 1, see `rfft`.
+
+    Parameters
+    ----------
+    coefficients : 1D array of filter taps
+    """
+
+    # rough cost of an FFT per point and stage, relative to a direct form
+    # multiply-add, from timing the matrix product against rfft and irfft
+    fft_cost = 2
+
+    def __init__(self, coefficients):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.reversed = np.ascontiguousarray(self.coefficients[::-1])
+        self.taps = self.coefficients.size
+        self.history = self.taps - 1
+        self.chunk = 0
+        self.buffer = np.zeros(self.history)
+        self._out = np.empty(0)
+        # FFT size for every block size, 0 for direct form
+        self.plans = {}
+        # filter spectrum and FFT scratch for every FFT size
+        self.spectra = {}
+
+    def plan(self, n):
+        """
+        FFT size used for blocks of `n` samples, or 0 for direct form.
+        """
+        size = self.plans.get(n)
+        if size is None:
+            size = 1 << (self.history + n - 1).bit_length()
+            if n * self.taps <= self.fft_cost * size * size.bit_length():
+                size = 0
+            elif size not in self.spectra:
+                self.spectra[size] = (np.fft.rfft(self.coefficients, size),
+                                      np.empty(size // 2 + 1, dtype=complex),
+                                      np.empty(size))
+            self.plans[n] = size
+        return size
+
+    def _prepare(self, n):
+        # shorter blocks fit the buffers and FFT size of the longest one,
+        # so the short last block of a file allocates nothing
+        if n <= self.chunk:
+            return
+        # the FFT reads the whole buffer up to its size
+        length = max(self.history + n, self.plan(n))
+        buffer = np.zeros(length)
+        buffer[:self.history] = self.buffer[:self.history]
+        self.buffer = buffer
+        self.chunk = n
+        self._out = np.empty(n)
+
+    def process(self, block, out=None):
+        """
+        Filters a block of samples.
+
+        Parameters
+        ----------
+        block : ndarray of input samples
+        out : optional ndarray to write the output into, can be `block`
+
+        Returns
+        -------
+        ndarray of the filtered block, `out` or a buffer valid until the
+        next call
+        """
+        n = block.size
+        self._prepare(n)
+        if out is None:
+            out = self._out[:n]
+        if n == 0:
+            return out
+        end = self.history + n
+        self.buffer[self.history:end] = block
+
+        size = self.plans[self.chunk]
+        if size == 0:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                self.buffer[:end], self.taps)
+            np.matmul(windows, self.reversed, out=out)
+        else:
+            response, spectrum, wrapped = self.spectra[size]
+            self.buffer[end:size] = 0
+            rfft(self.buffer[:size], spectrum)
+            spectrum *= response
+            irfft(spectrum, size, wrapped)
+            # the first taps - 1 outputs wrapped around, they are discarded
+            out[:] = wrapped[self.history:end]
+
+        self.buffer[:self.history] = self.buffer[n:end]
+        return out
+
+    def reset(self):
+        self.buffer[:] = 0
+
+
+class PartitionedConvolver:
+    """
+    Uniformly partitioned overlap-save convolution, for impulse responses
+    far longer than a block.
+
+    The impulse response is cut into partitions of `size` samples and the
+    spectrum of each, zero padded to 2 * size, is computed once. The
+    spectra of the last input partitions are kept in a frequency-domain
+    delay line, so a partition of input costs one forward and one inverse
+    FFT of 2 * size points and one multiply-add of the spectra, instead of
+    touching every sample of the impulse response. The contribution of all
+    but the newest partition only changes when a partition is completed,
+    so it is summed once per partition and blocks shorter than a partition
+    cost just the two FFTs. The output has no delay beyond the block size.
+
+    Parameters
+    ----------
+    response : 1D ndarray, the impulse response
+    size : partition length in samples, usually the chunk size
+    """
+
+    def __init__(self, response, size):
+        self.size = size
+        count = max(1, -(-len(response) // size))
+        self.count = count
+        partitions = np.zeros(count * size)
+        partitions[:len(response)] = response
+        padded = np.zeros((count, 2 * size))
+        padded[:, :size] = partitions.reshape(count, size)
+        self.spectra = np.fft.rfft(padded, axis=1)
+        self.reset()
+
+    def reset(self):
+        size = self.size
+        # the previous partition of input followed by the current one,
+        # zero past the samples received so far
+        self.window = np.zeros(2 * size)
+        self.position = 0
+        # mirrored, so the newest `count` spectra are always one slice
+        self.delayline = np.zeros((2 * self.count, size + 1), dtype=complex)
+        self.head = 0
+        self.tail = np.zeros(size + 1, dtype=complex)
+        self._spectrum = np.empty(size + 1, dtype=complex)
+        self._product = np.empty(size + 1, dtype=complex)
+        self._products = np.empty((self.count - 1, size + 1), dtype=complex)
+        self._wrapped = np.empty(2 * size)
+        self._out = np.empty(size)
+
+    def _advance(self, spectrum):
+        """
+        Pushes the spectrum of a completed partition into the delay line
+        and sums what the older partitions give the next one.
+        """
+        count = self.count
+        self.head = (self.head - 1) % count
+        self.delayline[self.head] = spectrum
+        self.delayline[self.head + count] = spectrum
+        if count > 1:
+            np.multiply(self.spectra[1:],
+                        self.delayline[self.head:self.head + count - 1],
+                        out=self._products)
+            np.sum(self._products, axis=0, out=self.tail)
+        self.window[:self.size] = self.window[self.size:]
+        self.window[self.size:] = 0
+        self.position = 0
+
+    def process(self, block):
+        """
+        Convolves a block of samples.
+
+        Returns
+        -------
+        ndarray of the convolved block, valid until the next call
+        """
+        n = block.size
+        if self._out.size < n:
+            self._out = np.empty(n)
+        out = self._out[:n]
+        size = self.size
+        done = 0
+        while done < n:
+            start = self.position
+            m = min(n - done, size - start)
+            self.window[size + start:size + start + m] = block[done:done + m]
+            rfft(self.window, self._spectrum)
+            np.multiply(self._spectrum, self.spectra[0], out=self._product)
+            self._product += self.tail
+            irfft(self._product, 2 * size, self._wrapped)
+            out[done:done + m] = self._wrapped[size + start:size + start + m]
+            self.position += m
+            done += m
+            if self.position == size:
+                self._advance(self._spectrum)
+        return out
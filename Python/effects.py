@@ -0,0 +1,566 @@
+"""
+    effects.py - Composable effect chain
+"""
+
+import time
+
+import numpy as np
+
+from dsp import (LFO, CombFilter, Compressor, DelayLine, FIRFilter,
+                 ModulatedDelay, PartitionedConvolver)
+
+
+def tanh_distort(v, ratio=0.5):
+    """
+    Exponential distortion function.
+
+    Parameters
+    ----------
+    x : ndarray of sample positions
+    rate : rate of distortion in samples
+
+    Returns
+    -------
+    ndarray of values 0-1, for relative distortion
+    """
+    return np.tanh(v) * ratio * np.sin(v)
+
+
+def clip_distort(v, ratio):
+    """
+    Clips values to a maximum
+    """
+    return np.where(np.abs(ratio * v) > 1, 1, v * ratio)
+
+
+def observed(observer, name, func):
+    """
+    Returns `func` reporting its start and end perf_counter times to
+    `observer` under `name` on every call.
+    """
+    def timed(*args):
+        start = time.perf_counter()
+        result = func(*args)
+        observer(name, start, time.perf_counter())
+        return result
+    return timed
+
+
+class Effect:
+    """
+    One stage of a Chain.
+
+    A stage processes a mono block in place, reading its settings from
+    the parameter snapshot of the current chunk. Any state it needs
+    between chunks lives on the stage, and any scratch space is allocated
+    once in `prepare`.
+    """
+    name = 'effect'
+
+    def __init__(self, bypass=False):
+        self.bypass = bypass
+        self.chunk = 0
+        self.framerate = 0
+
+    def prepare(self, chunk, framerate):
+        """
+        Called by the chain before the first block, and again if the
+        block size grows.
+        """
+        self.chunk = chunk
+        self.framerate = framerate
+
+    def enabled(self, params):
+        """
+        Whether the current parameters make this stage do anything.
+        """
+        return True
+
+    def process(self, block, params):
+        raise NotImplementedError
+
+    def reset(self):
+        """
+        Clears any state kept between chunks.
+        """
+        pass
+
+
+class Filter(Effect):
+    """
+    FIR filter with fixed coefficients, switched on by 'filter_enabled'.
+    """
+    name = 'filter'
+
+    def __init__(self, coefficients, bypass=False):
+        super().__init__(bypass)
+        self.coefficients = coefficients
+        self.fir = FIRFilter(coefficients)
+
+    def enabled(self, params):
+        return params['filter_enabled']
+
+    def process(self, block, params):
+        self.fir.process(block, out=block)
+
+    def reset(self):
+        self.fir.reset()
+
+
+class ClipDistort(Effect):
+    """
+    In place version of `clip_distort`, driven by 'clip_distort'.
+    """
+    name = 'clip_distort'
+
+    def prepare(self, chunk, framerate):
+        super().prepare(chunk, framerate)
+        self.scratch = np.empty(chunk)
+        self.mask = np.empty(chunk, dtype=bool)
+
+    def enabled(self, params):
+        return params['clip_distort'] > 0
+
+    def process(self, block, params):
+        n = block.size
+        scratch = self.scratch if n == self.chunk else self.scratch[:n]
+        mask = self.mask if n == self.chunk else self.mask[:n]
+        np.multiply(block, params['clip_distort'], out=block)
+        np.abs(block, out=scratch)
+        np.greater(scratch, 1, out=mask)
+        np.copyto(block, 1, where=mask)
+
+
+class TanhDistort(Effect):
+    """
+    In place version of `tanh_distort`, driven by 'tanh_distort'.
+    """
+    name = 'tanh_distort'
+
+    def prepare(self, chunk, framerate):
+        super().prepare(chunk, framerate)
+        self.scratch = np.empty(chunk)
+
+    def enabled(self, params):
+        return params['tanh_distort'] > 0
+
+    def process(self, block, params):
+        n = block.size
+        scratch = self.scratch if n == self.chunk else self.scratch[:n]
+        np.sin(block, out=scratch)
+        np.tanh(block, out=block)
+        block *= params['tanh_distort']
+        block *= scratch
+
+
+class Delay(Effect):
+    """
+    Echo of 'delay_secs' mixed in at 'delay_amplitude'.
+    """
+    name = 'delay'
+    max_secs = 5
+
+    def prepare(self, chunk, framerate):
+        if framerate != self.framerate:
+            self.line = DelayLine(self.max_secs * framerate)
+        super().prepare(chunk, framerate)
+
+    def enabled(self, params):
+        return int(params['delay_secs'] * self.framerate) > 0
+
+    def process(self, block, params):
+        length = int(params['delay_secs'] * self.framerate)
+        self.line.process(block, length, params['delay_amplitude'])
+
+    def reset(self):
+        self.line = DelayLine(self.max_secs * self.framerate)
+
+
+class Reverb(Effect):
+    """
+    Feedback comb of 'reverb_secs' with 'reverb_falloff' feedback, mixed
+    in at 'reverb_amplitude'.
+    """
+    name = 'reverb'
+    max_secs = 5
+
+    def prepare(self, chunk, framerate):
+        if framerate != self.framerate:
+            self.comb = CombFilter(self.max_secs * framerate)
+        super().prepare(chunk, framerate)
+
+    def enabled(self, params):
+        return int(params['reverb_secs'] * self.framerate) > 0
+
+    def process(self, block, params):
+        length = int(params['reverb_secs'] * self.framerate)
+        self.comb.process(block, length, params['reverb_falloff'],
+                          params['reverb_amplitude'])
+
+    def reset(self):
+        self.comb = CombFilter(self.max_secs * self.framerate)
+
+
+class Convolution(Effect):
+    """
+    Convolution reverb with a fixed impulse response, mixed in at
+    'convolution_mix'.
+
+    The impulse response is partitioned into chunks, so the cost per
+    chunk grows with the number of partitions rather than the length of
+    the response times the chunk size, and nothing is added to the
+    latency.
+    """
+    name = 'convolution'
+
+    def __init__(self, response, bypass=False):
+        super().__init__(bypass)
+        self.response = response
+
+    def prepare(self, chunk, framerate):
+        if chunk != self.chunk:
+            self.convolver = PartitionedConvolver(self.response, chunk)
+        super().prepare(chunk, framerate)
+
+    def enabled(self, params):
+        return params['convolution_mix'] > 0
+
+    def process(self, block, params):
+        y = self.convolver.process(block)
+        mix = params['convolution_mix']
+        y *= mix
+        block *= 1 - mix
+        block += y
+
+    def reset(self):
+        self.convolver.reset()
+
+
+class Dynamics(Effect):
+    """
+    Look-ahead compressor/limiter driven by 'compressor_threshold',
+    'compressor_ratio', 'compressor_attack' and 'compressor_release'
+    (seconds). The output is made up so a full scale input still comes
+    out at full scale, which with the default infinite ratio normalizes
+    anything louder than the threshold.
+
+    Delays the signal by the attack time.
+    """
+    name = 'compressor'
+
+    def __init__(self, bypass=False):
+        super().__init__(bypass)
+        self.compressor = Compressor()
+
+    def enabled(self, params):
+        return params['compressor_ratio'] > 1
+
+    def process(self, block, params):
+        threshold = params['compressor_threshold']
+        ratio = params['compressor_ratio']
+        self.compressor.process(
+            block, threshold, ratio,
+            int(params['compressor_attack'] * self.framerate),
+            params['compressor_release'] * self.framerate,
+            makeup=threshold ** (1 / ratio - 1))
+
+    def reset(self):
+        self.compressor.reset()
+
+
+class Flanger(Effect):
+    """
+    Flanger/chorus: a copy of the signal delayed by between
+    'flanger_min_secs' and 'flanger_max_secs', swept by an LFO of
+    'flanger_rate' Hz and 'flanger_shape', fed back at 'flanger_feedback'
+    and mixed in at 'flanger_mix'.
+
+    Delays of a few milliseconds with feedback flange, the default 40-80
+    ms range sounds more like a chorus.
+    """
+    name = 'flanger'
+    max_secs = 0.1
+
+    def __init__(self, bypass=False):
+        super().__init__(bypass)
+        self.lfo = LFO()
+
+    def prepare(self, chunk, framerate):
+        if framerate != self.framerate:
+            self.line = ModulatedDelay(int(self.max_secs * framerate))
+        super().prepare(chunk, framerate)
+        self.lfo.framerate = framerate
+        self.delays = np.empty(chunk)
+
+    def enabled(self, params):
+        return params['flanger_mix'] > 0
+
+    def process(self, block, params):
+        n = block.size
+        delays = self.delays if n == self.chunk else self.delays[:n]
+        # at least two samples, so the interpolation never reads ahead
+        low = min(max(params['flanger_min_secs'] * self.framerate, 2),
+                  self.line.capacity)
+        high = min(max(params['flanger_max_secs'] * self.framerate, low),
+                   self.line.capacity)
+
+        self.lfo.rate = params['flanger_rate']
+        self.lfo.shape = params['flanger_shape']
+        np.multiply(self.lfo.block(n), high - low, out=delays)
+        delays += low
+
+        feedback = params['flanger_feedback']
+        y = self.line.delayed(block, delays, feedback)
+        mix = params['flanger_mix']
+        # the feedback peaks at 1 / (1 - |feedback|), scaled back so the
+        # level does not jump with the feedback setting
+        y *= mix * (1 - abs(feedback))
+        block *= 1 - mix
+        block += y
+
+    def reset(self):
+        self.line = ModulatedDelay(int(self.max_secs * self.framerate))
+        self.lfo.phase = 0.0
+
+
+class Tremolo(Effect):
+    """
+    Amplitude modulation by an LFO of 'tremolo_rate' Hz and
+    'tremolo_shape', swinging the level down by up to 'tremolo_depth'.
+    """
+    name = 'tremolo'
+
+    def __init__(self, bypass=False):
+        super().__init__(bypass)
+        self.lfo = LFO()
+
+    def prepare(self, chunk, framerate):
+        super().prepare(chunk, framerate)
+        self.lfo.framerate = framerate
+        self.scratch = np.empty(chunk)
+
+    def enabled(self, params):
+        return params['tremolo_rate'] > 0 and params['tremolo_depth'] > 0
+
+    def process(self, block, params):
+        n = block.size
+        scratch = self.scratch if n == self.chunk else self.scratch[:n]
+        depth = params['tremolo_depth']
+        self.lfo.rate = params['tremolo_rate']
+        self.lfo.shape = params['tremolo_shape']
+        np.multiply(self.lfo.block(n), depth, out=scratch)
+        scratch += 1 - depth
+        block *= scratch
+
+    def reset(self):
+        self.lfo.phase = 0.0
+
+
+class Chain:
+    """
+    Ordered list of effect stages sharing one working buffer.
+
+    Stages can be looked up, moved and bypassed by name while the chain
+    is stopped, and keep their state from one chunk to the next.
+
+    If `observer` is set it is called with the name, start and end
+    perf_counter times of every stage that runs.
+    """
+
+    def __init__(self, stages, chunk, framerate):
+        self.stages = list(stages)
+        self.chunk = chunk
+        self.framerate = framerate
+        self.observer = None
+        self.buffer = np.zeros(chunk)
+        for stage in self.stages:
+            stage.prepare(chunk, framerate)
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def block(self, n):
+        """
+        Returns the working buffer for an `n` sample block. Fill it with
+        the input before calling `process`.
+        """
+        if n == self.chunk:
+            return self.buffer
+        if n > self.chunk:
+            self.chunk = n
+            self.buffer = np.zeros(n)
+            for stage in self.stages:
+                stage.prepare(n, self.framerate)
+            return self.buffer
+        return self.buffer[:n]
+
+    def process(self, block, params):
+        """
+        Runs every active stage over `block` in place, in order.
+
+        Parameters
+        ----------
+        block : working buffer returned by `block`
+        params : parameter snapshot for this chunk
+
+        Returns
+        -------
+        the processed block
+        """
+        observer = self.observer
+        for stage in self.stages:
+            if not stage.bypass and stage.enabled(params):
+                if observer is None:
+                    stage.process(block, params)
+                else:
+                    start = time.perf_counter()
+                    stage.process(block, params)
+                    observer(stage.name, start, time.perf_counter())
+        return block
+
+    def move(self, name, index):
+        """
+        Moves the named stage to position `index`.
+        """
+        stage = self[name]
+        self.stages.remove(stage)
+        self.stages.insert(index, stage)
+
+    def set_bypass(self, name, bypass=True):
+        self[name].bypass = bypass
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+
+class BufferArena:
+    """
+    Every buffer the per-chunk input and output path needs, sized once
+    from the chunk length and channel counts.
+
+    Views of the full-size buffers are taken up front as well, so a full
+    chunk goes through without creating any new arrays. Only a shorter
+    chunk, such as the last one of a file, slices new views.
+    """
+
+    def __init__(self, chunk, channels, input_channels=1):
+        self.chunk = chunk
+        self.channels = channels
+        self.input_channels = input_channels
+
+        self.raw = np.zeros(chunk * input_channels, dtype=np.int16)
+        self.raw_bytes = memoryview(self.raw).cast('B')
+        self.inputs = self.raw[::input_channels]
+
+        self.frames = np.zeros((chunk, channels))
+        self.interleaved = self.frames.reshape(-1)
+        self.columns = tuple(self.frames[:, c] for c in range(channels))
+        self.out = np.zeros(chunk * channels, dtype=np.int16)
+
+    def load(self, data):
+        """
+        Copies a chunk of interleaved int16 input bytes into the arena.
+
+        Returns
+        -------
+        ndarray view of the first input channel
+        """
+        size = len(data)
+        if size == self.raw_bytes.nbytes:
+            self.raw_bytes[:] = data
+            return self.inputs
+        self.raw_bytes[:size] = data
+        n = size // (2 * self.input_channels)
+        return self.raw[:n * self.input_channels:self.input_channels]
+
+
+class StereoOutput:
+    """
+    Fused output stage: fade, interleave, volume and int16 conversion.
+
+    The first two output channels get the block scaled by 1 - 'fade' and
+    'fade', any further channels get it unfaded. With a 'pan_rate' above
+    zero the fade is swept by an LFO of that rate and 'pan_shape', mixed
+    in at 'pan_depth', which pans the sound back and forth. The faded frames are
+    handed to `tap` before the volume is applied, then scaled by 'volume'
+    and converted straight into the arena's int16 output buffer.
+
+    If `observer` is set it is called with 'ring_write' and the start and
+    end perf_counter times of the tap write.
+    """
+
+    def __init__(self, arena, framerate=44100):
+        self.arena = arena
+        self.observer = None
+        self.pan = LFO(framerate=framerate)
+        self.fades = np.zeros(arena.chunk)
+
+    def _pan(self, n, params):
+        """
+        Per sample fade for an `n` frame block.
+        """
+        fades = self.fades if n == self.arena.chunk else self.fades[:n]
+        depth = params['pan_depth']
+        self.pan.rate = params['pan_rate']
+        self.pan.shape = params['pan_shape']
+        np.multiply(self.pan.block(n), depth, out=fades)
+        fades += (1 - depth) * params['fade']
+        return fades
+
+    def process(self, block, params, tap=None):
+        """
+        Parameters
+        ----------
+        block : processed mono block
+        params : parameter snapshot for this chunk
+        tap : optional RingBuffer to receive the frames before volume
+
+        Returns
+        -------
+        ndarray of interleaved int16 samples, valid until the next call
+        """
+        arena = self.arena
+        n = block.size
+        if n == arena.chunk:
+            columns = arena.columns
+            frames = arena.interleaved
+            out = arena.out
+        else:
+            columns = tuple(column[:n] for column in arena.columns)
+            frames = arena.frames[:n].reshape(-1)
+            out = arena.out[:n * arena.channels]
+
+        fade = params['fade']
+        if arena.channels >= 2 and params['pan_rate'] > 0:
+            np.multiply(block, self._pan(n, params), out=columns[1])
+            np.subtract(block, columns[1], out=columns[0])
+        elif arena.channels >= 2 and fade != 0.5:
+            np.multiply(block, 1 - fade, out=columns[0])
+            np.multiply(block, fade, out=columns[1])
+        else:
+            np.copyto(columns[0], block)
+            if arena.channels >= 2:
+                np.copyto(columns[1], block)
+        for c in range(2, arena.channels):
+            np.copyto(columns[c], block)
+
+        if tap is not None:
+            if self.observer is None:
+                tap.write(frames)
+            else:
+                start = time.perf_counter()
+                tap.write(frames)
+                self.observer('ring_write', start, time.perf_counter())
+
+        # scale in place and cast separately, as a multiply straight into
+        # int16 allocates a cast buffer. The cast truncates like astype
+        frames *= params['volume']
+        np.copyto(out, frames, casting='unsafe')
+        return out
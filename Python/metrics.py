@@ -0,0 +1,314 @@
+"""
+    metrics.py - Audio thread instrumentation and export
+
+    The audio thread only does a bisect and a few integer additions per
+    measurement. Everything else, formatting and writing the numbers out,
+    happens on the exporter's own thread. The exporter reads the counters
+    without a lock, so one export can be a chunk out of step between two
+    histograms, which is fine for monitoring.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def log_buckets(low, high, per_decade=10):
+    """
+    Upper bucket edges spaced evenly on a log scale from `low` to `high`.
+    """
+    edges = []
+    edge = low
+    step = 10 ** (1 / per_decade)
+    while edge <= high * (1 + 1e-9):
+        edges.append(float(f"{edge:.3g}"))
+        edge *= step
+    return edges
+
+
+class Histogram:
+    """
+    Counts of values in fixed buckets, plus their count, sum and maximum.
+
+    Parameters
+    ----------
+    bounds : ascending upper edges of the buckets. Values above the last
+        one go in an extra overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Upper edge of the bucket holding the `q` quantile, or the largest
+        value seen if it is in the overflow bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'bounds': self.bounds,
+            'counts': list(self.counts),
+        }
+
+    def to_text(self, name, labels=''):
+        """
+        Prometheus text format lines for this histogram.
+        """
+        sep = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.total}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+TIME_BUCKETS = log_buckets(1e-5, 1)
+BUDGET_BUCKETS = [round(0.05 * i, 2) for i in range(1, 41)]
+DEPTH_BUCKETS = [0] + [2 ** i for i in range(17)]
+
+
+class Metrics:
+    """
+    Timing, xrun and queue depth measurements of one stream.
+
+    `stage` has the signature of a Chain observer, so per-stage timings
+    come straight from the effect chain.
+
+    Parameters
+    ----------
+    chunk : frames per chunk
+    framerate : sample rate, together with `chunk` sets the real time
+        budget of a chunk
+    """
+
+    def __init__(self, chunk=1024, framerate=44100):
+        self.chunk_time = Histogram(TIME_BUCKETS)
+        self.budget_used = Histogram(BUDGET_BUCKETS)
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self.stage_time = {}
+        self.overflows = 0
+        self.underflows = 0
+        self.late = 0
+        self.started = time.time()
+        self.prepare(chunk, framerate)
+
+    def prepare(self, chunk, framerate):
+        self.chunk = chunk
+        self.framerate = framerate
+        self.budget = chunk / framerate
+
+    def timed(self, process):
+        """
+        Wraps a chunk processor so every call is timed.
+        """
+        def timed_process(data):
+            start = time.perf_counter()
+            result = process(data)
+            self.chunk_done(start, time.perf_counter())
+            return result
+        return timed_process
+
+    def chunk_done(self, start, end):
+        elapsed = end - start
+        self.chunk_time.add(elapsed)
+        used = elapsed / self.budget
+        self.budget_used.add(used)
+        if used > 1:
+            self.late += 1
+
+    def stage(self, name, start, end):
+        histogram = self.stage_time.get(name)
+        if histogram is None:
+            histogram = self.stage_time[name] = Histogram(TIME_BUCKETS)
+        histogram.add(end - start)
+
+    def overflow(self, count=1):
+        self.overflows += count
+
+    def underflow(self, count=1):
+        self.underflows += count
+
+    def poll(self, source, sink):
+        """
+        Picks up the xrun counters and input queue depth of a pair of
+        backends, once per chunk.
+        """
+        self.overflows = source.overflows
+        self.underflows = sink.underflows
+        self.queue_depth.add(source.pending())
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'chunk': self.chunk,
+            'framerate': self.framerate,
+            'budget_seconds': self.budget,
+            'chunks': self.chunk_time.count,
+            'late_chunks': self.late,
+            'input_overflows': self.overflows,
+            'output_underflows': self.underflows,
+            'chunk_seconds': self.chunk_time.to_dict(),
+            'budget_used': self.budget_used.to_dict(),
+            'queue_depth_frames': self.queue_depth.to_dict(),
+            'stage_seconds': {name: histogram.to_dict()
+                              for name, histogram in list(self.stage_time.items())},
+        }
+
+    def to_text(self, prefix='statsplay'):
+        """
+        All measurements in the Prometheus text format.
+        """
+        lines = [
+            f'# TYPE {prefix}_chunks_total counter',
+            f'{prefix}_chunks_total {self.chunk_time.count}',
+            f'# TYPE {prefix}_late_chunks_total counter',
+            f'{prefix}_late_chunks_total {self.late}',
+            f'# TYPE {prefix}_input_overflows_total counter',
+            f'{prefix}_input_overflows_total {self.overflows}',
+            f'# TYPE {prefix}_output_underflows_total counter',
+            f'{prefix}_output_underflows_total {self.underflows}',
+            f'# TYPE {prefix}_budget_seconds gauge',
+            f'{prefix}_budget_seconds {self.budget}',
+            f'# TYPE {prefix}_chunk_seconds histogram',
+        ]
+        lines += self.chunk_time.to_text(f'{prefix}_chunk_seconds')
+        lines.append(f'# TYPE {prefix}_budget_used histogram')
+        lines += self.budget_used.to_text(f'{prefix}_budget_used')
+        lines.append(f'# TYPE {prefix}_queue_depth_frames histogram')
+        lines += self.queue_depth.to_text(f'{prefix}_queue_depth_frames')
+        lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+        for name, histogram in list(self.stage_time.items()):
+            lines += histogram.to_text(f'{prefix}_stage_seconds', f'stage="{name}"')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        chunk = self.chunk_time
+        return (f"{chunk.count} chunks, mean {1000 * chunk.total / max(chunk.count, 1):.3f} ms, "
+                f"p99 {1000 * chunk.quantile(0.99):.3f} ms, max {1000 * chunk.max:.3f} ms "
+                f"of a {1000 * self.budget:.2f} ms budget, {self.late} late, "
+                f"{self.overflows} input overflows, {self.underflows} output underflows")
+
+
+class MetricsExporter:
+    """
+    Publishes a Metrics object from a background thread.
+
+    Parameters
+    ----------
+    metrics : Metrics to export
+    target : a port number to serve /metrics (text) and /metrics.json on
+        localhost, or a file to rewrite every `interval` seconds. Files
+        ending in .json get the JSON snapshot, anything else the text
+        format.
+    interval : seconds between file writes and log lines
+    """
+
+    def __init__(self, metrics, target, interval=5.0):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = None
+        self.server = None
+        self.stopped = threading.Event()
+
+        if str(target).isdigit():
+            self.server = ThreadingHTTPServer(('127.0.0.1', int(target)),
+                                              self._handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info(f"Serving metrics on http://127.0.0.1:{target}/metrics")
+        else:
+            self.path = target
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.to_text().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def write(self):
+        """
+        Replaces the metrics file in one step, so a scraper never reads a
+        half written one.
+        """
+        if self.path is None:
+            return
+        if self.path.endswith('.json'):
+            body = json.dumps(self.metrics.snapshot(), indent=1)
+        else:
+            body = self.metrics.to_text()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(body)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+            logging.info(f"Metrics: {self.metrics.summary()}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,275 @@
+"""
+    plotting.py - Live waveform and spectrum plotting helpers
+"""
+
+import time
+
+import numpy as np
+
+
+def minmax_decimate(array, factor, out=None):
+    """
+    Decimates an array by a factor, keeping the smallest and largest value
+    of every block of `factor` samples so transients stay visible.
+
+    Parameters
+    ----------
+    array : ndarray, length a multiple of `factor`
+    factor : number of samples per block
+    out : optional ndarray of twice the number of blocks to write into
+
+    Returns
+    -------
+    ndarray of alternating block minimum and maximum
+    """
+    blocks = array.reshape(-1, factor)
+    if out is None:
+        out = np.empty(2 * blocks.shape[0], dtype=array.dtype)
+    np.min(blocks, axis=1, out=out[0::2])
+    np.max(blocks, axis=1, out=out[1::2])
+    return out
+
+
+class Trace:
+    """
+    One plotted line fed from a RingBuffer.
+
+    Parameters
+    ----------
+    line : matplotlib Line2D to update
+    source : RingBuffer holding the samples
+    window : number of frames to plot
+    factor : decimation factor
+    channels : number of interleaved channels in `source`
+    channel : channel to plot
+    offset : constant added to the plotted values
+    """
+
+    def __init__(self, line, source, window, factor, channels=1, channel=0,
+                 offset=0):
+        self.line = line
+        self.source = source
+        self.window = window
+        self.factor = factor
+        self.channels = channels
+        self.channel = channel
+        self.offset = offset
+
+        blocks = window // factor
+        self.y = np.zeros(2 * blocks)
+        # every block is drawn as a vertical stroke from min to max
+        self.line.set_data(np.repeat(np.arange(blocks), 2), self.y)
+        self.line.set_animated(True)
+        self.artists = [line]
+
+    def update(self):
+        data = self.source.latest(self.window * self.channels)
+        minmax_decimate(data[self.channel::self.channels], self.factor, out=self.y)
+        if self.offset != 0:
+            self.y += self.offset
+        self.line.set_ydata(self.y)
+
+
+class Spectrogram:
+    """
+    Incremental short time Fourier transform of a RingBuffer, drawn as a
+    live spectrum line and a scrolling spectrogram image.
+
+    Only windows that end in samples written since the last update are
+    transformed, all of them in one rfft call, so the cost of a frame
+    follows the amount of new audio rather than the length of the history.
+    The columns are kept twice in a preallocated image, `columns` apart,
+    so the scrolled view is a slice instead of a roll.
+
+    Parameters
+    ----------
+    source : RingBuffer holding the samples
+    framerate : sample rate of `source` in Hz
+    line : optional matplotlib Line2D for the latest spectrum
+    image : optional matplotlib AxesImage for the spectrogram
+    nfft : window length in frames
+    hop : frames between the starts of consecutive windows
+    columns : number of windows the spectrogram shows
+    channels : number of interleaved channels in `source`
+    channel : channel to analyse
+    floor : level in dB that silence is shown at
+    headroom : most frames the writer adds at once, kept free so the
+        windows being read are not overwritten before `window` returns
+    """
+
+    def __init__(self, source, framerate, line=None, image=None, nfft=1024,
+                 hop=512, columns=256, channels=1, channel=0, floor=-100.0,
+                 headroom=1024):
+        self.source = source
+        self.nfft = nfft
+        self.hop = hop
+        self.columns = columns
+        self.channels = channels
+        self.channel = channel
+        self.floor = floor
+
+        self.window = np.hanning(nfft)
+        # full scale sine reads as 0 dB
+        self.scale = 2 / self.window.sum()
+        self.frequencies = np.fft.rfftfreq(nfft, 1 / framerate)
+        bins = self.frequencies.size
+        self.spectrum = np.full(bins, floor)
+        self.image = np.full((bins, 2 * columns), floor)
+        self.column = 0
+        # end, in frames of `source`, of the next window to transform
+        self.next_end = nfft
+        # no more windows than fit in the ring buffer, less a chunk the
+        # writer can add meanwhile, or on screen
+        capacity = source.capacity // channels
+        self.max_windows = max(1, min(columns,
+                                      (capacity - nfft - headroom) // hop + 1))
+
+        self.line = line
+        self.image_artist = image
+        self.artists = []
+        if line is not None:
+            line.set_data(self.frequencies, self.spectrum)
+            line.set_animated(True)
+            self.artists.append(line)
+        if image is not None:
+            image.set_data(self.view())
+            image.set_animated(True)
+            self.artists.append(image)
+
+    def view(self):
+        """
+        Spectrogram image, oldest column first, as a view.
+        """
+        return self.image[:, self.column:self.column + self.columns]
+
+    def update(self):
+        """
+        Transforms the windows completed since the last call.
+
+        Returns
+        -------
+        number of new columns
+        """
+        while True:
+            available = self.source.count // self.channels
+            if available < self.next_end:
+                return 0
+            count = (available - self.next_end) // self.hop + 1
+            if count > self.max_windows:
+                # fell behind, skip straight to the newest windows
+                self.next_end += (count - self.max_windows) * self.hop
+                count = self.max_windows
+
+            start = self.next_end - self.nfft
+            end = self.next_end + (count - 1) * self.hop
+            try:
+                samples = self.source.window(end * self.channels,
+                                             (end - start) * self.channels)
+                break
+            except ValueError:
+                # the writer lapped the oldest window after the count was
+                # read, look again and skip ahead
+                continue
+        samples = samples[self.channel::self.channels]
+        frames = np.lib.stride_tricks.sliding_window_view(
+            samples, self.nfft)[::self.hop]
+
+        magnitude = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        magnitude *= self.scale
+        np.maximum(magnitude, 10 ** (self.floor / 20), out=magnitude)
+        levels = 20 * np.log10(magnitude)
+
+        index = (self.column + np.arange(count)) % self.columns
+        self.image[:, index] = levels.T
+        self.image[:, index + self.columns] = levels.T
+        self.column = (self.column + count) % self.columns
+        self.spectrum[:] = levels[-1]
+        self.next_end = end + self.hop
+
+        if self.line is not None:
+            self.line.set_ydata(self.spectrum)
+        if self.image_artist is not None:
+            self.image_artist.set_data(self.view())
+        return count
+
+
+class PlotRenderer:
+    """
+    Blits a set of traces at no more than `fps` frames per second, and
+    only when one of their sources has new samples.
+
+    A trace is anything with a `source` RingBuffer, an `update` method
+    and a list of `artists` to draw.
+
+    Between frames the renderer sleeps instead of spinning, which leaves
+    the GIL to the audio thread.
+    """
+
+    def __init__(self, fig, fps=30):
+        self.fig = fig
+        self.interval = 1 / fps
+        self.traces = []
+        self.axes = []
+        self.backgrounds = []
+        self.seen = {}
+        self.next_frame = time.perf_counter()
+        # backgrounds are cached again whenever matplotlib does a full
+        # redraw, e.g. after the window is resized
+        fig.canvas.mpl_connect('draw_event', self._cache_backgrounds)
+
+    def add(self, ax, trace):
+        """
+        Draws `trace` on `ax`. A trace with artists on several axes is
+        added once for each of them.
+        """
+        if trace not in self.traces:
+            self.traces.append(trace)
+        if ax not in self.axes:
+            self.axes.append(ax)
+        self.seen[id(trace.source)] = -1
+
+    def _cache_backgrounds(self, event=None):
+        self.backgrounds = [self.fig.canvas.copy_from_bbox(ax.bbox)
+                            for ax in self.axes]
+
+    def wait(self):
+        """
+        Sleeps until the next frame is due, handling GUI events meanwhile.
+        """
+        self.fig.canvas.flush_events()
+        delay = self.next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame + self.interval,
+                              time.perf_counter())
+
+    def draw(self):
+        """
+        Redraws the traces if there is new data.
+
+        Returns
+        -------
+        True if a frame was drawn
+        """
+        fresh = False
+        for trace in self.traces:
+            count = trace.source.count
+            if self.seen[id(trace.source)] != count:
+                self.seen[id(trace.source)] = count
+                fresh = True
+        if not fresh:
+            return False
+
+        if len(self.backgrounds) != len(self.axes):
+            self._cache_backgrounds()
+
+        for trace in self.traces:
+            trace.update()
+        for ax, background in zip(self.axes, self.backgrounds):
+            self.fig.canvas.restore_region(background)
+            for trace in self.traces:
+                for artist in trace.artists:
+                    if artist.axes is ax:
+                        ax.draw_artist(artist)
+            self.fig.canvas.blit(ax.bbox)
+        return True
@@ -1,62 +1,124 @@
-import pyaudio
-import wave
 import numpy as np
 import sys, getopt
 
+from backends import (QueuedSink, ResampledSource, SegmentedWavSink, WavSink,
+                      open_source)
+
 # dict config: {
-# form: pyaudio.paInt32
+# sample_width: 4
 # chans: 
 # sample_rate:
+# device_rate:
 # chunk_size: 
 # record_secs: 
 # dev_index: 
 # 
 # }
-help_str = "record.py - .wav file recorder\nUsage:\n\t-h\t\thelp\n\t-o\t<file>\toutput file name\n\t[-t]\t<sec>\tduration of recording (seconds) [default: 1]\n\t[-c]\t<num>\tNumber of channels [default: 1]\n\t[-d]\t<index>\tDevice Index [default: 0]"
+help_str = "record.py - .wav file recorder\nUsage:\n\t-h\t\thelp\n\t-o\t<file>\toutput file name\n\t[-t]\t<sec>\tduration of recording (seconds), 0 records until interrupted [default: 1]\n\t[-c]\t<num>\tNumber of channels [default: 1]\n\t[-d]\t<index>\tDevice Index [default: 0]\n\t[-s]\t<source>\tmic, sine[:<freq>], noise or a wav file, resampled to the recording rate if its own is different [default: mic]\n\t[-a]\t<hz>\topen the sound card at <hz> and resample to the recording rate [default: the recording rate]\n\t[-r]\t<sec>\tstart a new file every <sec> seconds\n\t[-b]\t<bytes>\tstart a new file every <bytes> bytes of samples, k, M and G suffixes allowed"
 options_dict = {
-    'format': pyaudio.paInt32,
+    'sample_width': 4,
     'chans': 1,
     'sample_rate': 16000,
+    'device_rate': 0,
     'chunk_size': 1024,
     'record_secs': 1,
     'dev_index': 0,
+    'source': 'mic',
+    'queue_chunks': 64,
+    'segment_secs': 0,
+    'segment_bytes': 0,
     'filename': ""
 }
 
 
 
-def record(opt, audio):    
-
-    # create pyaudio stream object
-    stream = audio.open(format=opt['format'], rate=opt['sample_rate'], channels=opt['chans'], input_device_index=opt['dev_index'], input=True, frames_per_buffer=opt['chunk_size'])
-
-    frames = []
-
-    for i in range(0, (opt['sample_rate']//opt['chunk_size'])*opt['record_secs']):
-        data = stream.read(opt['chunk_size'])
-        # np_arr = np.frombuffer(data, dtype=np.int16)
-        # np_arr = np.repeat(np_arr, 2)
-        # frames.append(np_arr.astype(np.int16).tobytes())
-        frames.append(data)
-        
-    print("Finished Recording.")
-
-    # close resources
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
-
-    # save wav file
-    wavefile = wave.open(opt['filename'], 'wb')
-    wavefile.setnchannels(1)
-    wavefile.setsampwidth(audio.get_sample_size(opt['format']))
-    wavefile.setframerate(opt['sample_rate'])
-    wavefile.writeframes(b''.join(frames))
-    wavefile.close()
+def parse_size(text):
+    """
+    Parses a byte count with an optional k, M or G suffix
+    """
+    scale = {'k': 2**10, 'm': 2**20, 'g': 2**30}.get(text[-1:].lower())
+    if scale is None:
+        return int(text)
+    return int(float(text[:-1]) * scale)
+
+
+def segment_length(opt, rate, frame_bytes):
+    """
+    Frames per segment from the rotation options, or None to write a
+    single file
+    """
+    lengths = []
+    if opt['segment_secs'] > 0:
+        lengths.append(int(opt['segment_secs'] * rate))
+    if opt['segment_bytes'] > 0:
+        lengths.append(opt['segment_bytes'] // frame_bytes)
+    if not lengths:
+        return None
+    return max(1, min(lengths))
+
+
+def record(opt, source):
+    """
+    Records from a source into a wav file
+
+    Chunks are written by a writer thread as they come in, through a queue
+    of at most opt['queue_chunks'] chunks, so memory use stays the same
+    however long the recording is. The wav header is patched with the
+    final length when the file is closed, including when the recording
+    is interrupted.
+
+    With opt['segment_secs'] or opt['segment_bytes'] set the recording is
+    split over numbered files with an index, see SegmentedWavSink.
+
+    Parameters
+    ----------
+    opt : options_dict
+    source : Backend to record from, closed when done
+
+    Returns
+    -------
+    number of frames recorded
+    """
+
+    frame_bytes = source.channels * source.sample_width
+    segment_frames = segment_length(opt, source.rate, frame_bytes)
+    if segment_frames is None:
+        sink = WavSink(opt['filename'], source.rate, source.channels,
+                       source.sample_width)
+    else:
+        sink = SegmentedWavSink(opt['filename'], segment_frames, source.rate,
+                                source.channels, source.sample_width)
+    sink = QueuedSink(sink, maxsize=opt['queue_chunks'])
+
+    # None records until interrupted or the source runs out
+    remaining = None
+    if opt['record_secs'] > 0:
+        remaining = int(opt['record_secs'] * source.rate)
+
+    frames = 0
+    try:
+        while remaining is None or frames < remaining:
+            n = opt['chunk_size']
+            if remaining is not None:
+                n = min(n, remaining - frames)
+            data = source.read(n)
+            if len(data) == 0:
+                break
+            sink.write(data)
+            frames += len(data) // frame_bytes
+    except KeyboardInterrupt:
+        print("Interrupted.")
+    finally:
+        # close resources
+        source.close()
+        sink.close()
+
+    print(f"Finished Recording {frames / source.rate:.2f} seconds.")
+    return frames
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "ho:t:c:d:")
+        opts, args = getopt.getopt(argv, "ho:t:c:d:s:r:b:a:")
     except getopt.GetoptError:
         print(help_str)
         exit(1)
@@ -68,22 +130,39 @@ def main(argv):
         elif opt == '-o':
             options_dict['filename'] = arg
         elif opt == '-t':
-            options_dict['record_secs'] = int(arg)
+            options_dict['record_secs'] = float(arg)
         elif opt == '-c':
-            options_dict['chans'] = arg
+            options_dict['chans'] = int(arg)
         elif opt == '-d':
             options_dict['dev_index'] = int(arg)
+        elif opt == '-s':
+            options_dict['source'] = arg
+        elif opt == '-r':
+            options_dict['segment_secs'] = float(arg)
+        elif opt == '-b':
+            options_dict['segment_bytes'] = parse_size(arg)
+        elif opt == '-a':
+            options_dict['device_rate'] = int(arg)
 
     if options_dict['filename'] == "":
         print("Must specify filename.")
         print(help_str)
         exit(1)
 
-    audio = pyaudio.PyAudio()
+    source = open_source(options_dict['source'],
+                         options_dict['device_rate'] or options_dict['sample_rate'],
+                         options_dict['chans'], options_dict['sample_width'],
+                         device=options_dict['dev_index'],
+                         frames_per_buffer=options_dict['chunk_size'])
+    if source.rate != options_dict['sample_rate']:
+        source = ResampledSource(source, options_dict['sample_rate'])
 
-    print('\n', f"Recording {options_dict['record_secs']} seconds to {options_dict['filename']}...", sep='')
+    if options_dict['record_secs'] > 0:
+        print('\n', f"Recording {options_dict['record_secs']} seconds to {options_dict['filename']}...", sep='')
+    else:
+        print('\n', f"Recording to {options_dict['filename']} until interrupted...", sep='')
 
-    record(options_dict, audio)
+    record(options_dict, source)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,120 @@
+"""
+    ringbuffer.py - Lock-free sample buffer between the audio thread and
+    the plots, optionally in shared memory
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed capacity single-producer/single-consumer sample buffer.
+
+    Every sample is stored twice, `capacity` apart, so the most recent
+    window is always one contiguous slice and can be read without copying.
+    The writer publishes the new head only after the samples are in place,
+    so the reader never needs a lock. A window can be overwritten while it
+    is still being read once the writer laps it.
+
+    The head counter and samples can live in a caller supplied buffer,
+    which lets `shared` and `attach` put them in shared memory so the
+    reader can be another process.
+    """
+
+    def __init__(self, capacity, dtype=np.float64, buffer=None):
+        self.capacity = capacity
+        self.shm = None
+        if buffer is None:
+            buffer = bytearray(RingBuffer.nbytes(capacity, dtype))
+        # total number of samples written, kept in an array so the
+        # counter can live next to the samples in shared storage
+        self.head = np.ndarray((1,), dtype=np.int64, buffer=buffer)
+        self.array = np.ndarray((2 * capacity,), dtype=dtype, buffer=buffer,
+                                offset=self.head.nbytes)
+
+    @staticmethod
+    def nbytes(capacity, dtype=np.float64):
+        return np.dtype(np.int64).itemsize + 2 * capacity * np.dtype(dtype).itemsize
+
+    @classmethod
+    def shared(cls, capacity, dtype=np.float64):
+        """
+        Creates a ring buffer in a new shared memory block. Its `shm.name`
+        is what `attach` needs.
+        """
+        shm = shared_memory.SharedMemory(
+            create=True, size=cls.nbytes(capacity, dtype))
+        ring = cls(capacity, dtype, buffer=shm.buf)
+        ring.shm = shm
+        return ring
+
+    @classmethod
+    def attach(cls, name, capacity, dtype=np.float64):
+        """
+        Opens a ring buffer created by `shared` in another process.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        ring = cls(capacity, dtype, buffer=shm.buf)
+        ring.shm = shm
+        return ring
+
+    def close(self, unlink=False):
+        """
+        Releases the shared memory block, if there is one. The creator
+        should pass unlink=True once every process is done with it.
+        """
+        if self.shm is None:
+            return
+        # the views have to go before the block can be closed
+        del self.array, self.head
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
+
+    @property
+    def count(self):
+        return int(self.head[0])
+
+    def write(self, block):
+        """
+        Append a block of samples, dropping the oldest ones.
+        """
+        total = len(block)
+        block = block[-self.capacity:]
+        n = len(block)
+        start = (self.count + total - n) % self.capacity
+        first = min(n, self.capacity - start)
+        rest = n - first
+
+        self.array[start:start + first] = block[:first]
+        self.array[start + self.capacity:start + self.capacity + first] = block[:first]
+        self.array[:rest] = block[first:]
+        self.array[self.capacity:self.capacity + rest] = block[first:]
+
+        self.head[0] += total
+
+    def latest(self, n):
+        """
+        Returns a read-only view of the last `n` samples written, oldest
+        first. Samples that were never written read as zero.
+        """
+        end = self.count % self.capacity + self.capacity
+        window = self.array[end - n:end]
+        window.flags.writeable = False
+        return window
+
+    def window(self, end, n):
+        """
+        Returns a read-only view of the `n` samples before the absolute
+        sample index `end`, which have to still be in the buffer.
+        """
+        count = self.count
+        if end > count or end - n < count - self.capacity:
+            raise ValueError("Window is not in the buffer")
+        stop = end % self.capacity + self.capacity
+        window = self.array[stop - n:stop]
+        window.flags.writeable = False
+        return window
@@ -4,17 +4,35 @@
     Rauly Baggett
 """
 
+import functools
+import gc
 import getopt
 import logging
+import multiprocessing
+import os
 import sys
 import threading
 import time
+import tracemalloc
+from collections.abc import Mapping
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pyaudio
 from matplotlib import widgets
 
+from backends import ResampledSink, ResampledSource, open_sink, open_source
+from dsp import Resampler, load_coefficients
+from effects import (BufferArena, Chain, ClipDistort, Convolution, Delay,
+                     Dynamics, Filter, Flanger, Reverb, StereoOutput,
+                     TanhDistort, Tremolo, observed)
+from metrics import Metrics, MetricsExporter
+from plotting import PlotRenderer, Spectrogram, Trace
+from ringbuffer import RingBuffer
+from tracing import SpanRecorder
+from wavfile import MappedWav
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Resources')
+
 global raise_exception
 
 global options
@@ -25,37 +43,16 @@ options = {
     "framerate": 44100,
     "channels": 2,
     "input_channels": 1,
-    "format": pyaudio.paInt16,
+    "sample_width": 2,
     "filter": "equiripple56.mat",
     "filter_type": "equiripple",
     "filter_order": 56,
     "filter_coef": 0,
+    "impulse_response": "",
+    "plot_window": 48000,
 }
 
 
-class AtomicArray:
-    def __init__(self, size):
-        self.size = size
-        self.array = np.zeros(size)
-        self._lock = threading.Lock()
-
-    def set(self, value):
-        with self._lock:
-            self.array = value
-
-    def append(self, value):
-        with self._lock:
-            self.array = np.append(self.array, value)
-
-    def get(self):
-        with self._lock:
-            return self.array
-
-    def remove(self, value):
-        with self._lock:
-            self.array = np.delete(self.array, value)
-
-
 class AtomicDict:
     def __init__(self, init_dict={}):
         self.dict = init_dict
@@ -78,46 +75,291 @@ class AtomicDict:
             self.dict[key] = value
 
 
-def fadefunc(x, framerate, rate=2):
+class ParamSnapshot(Mapping):
     """
-    Channel fade function.
+    Immutable set of parameter values tagged with the version it was
+    published as.
+    """
+    __slots__ = ('_values', 'version')
 
-    Parameters
-    ----------
-    x : ndarray of sample positions
-    rate : rate of fade in samples
+    def __init__(self, values, version):
+        self._values = values
+        self.version = version
 
-    Returns
-    -------
-    ndarray of values 0-1, for relative fade between left and right channels
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class ParamStore:
     """
-    return (np.sin(rate * x * np.pi / framerate) + 1) / 2
+    Versioned parameter store.
 
+    Readers take the current snapshot with a single attribute load and
+    never lock, so a chunk that reads everything from one snapshot always
+    sees a consistent set of values. Writers copy the values, apply their
+    change and publish the result as a new snapshot in one assignment.
+    """
+
+    def __init__(self, init_dict=None):
+        self._lock = threading.Lock()
+        self._snapshot = ParamSnapshot(dict(init_dict or {}), 0)
 
-def tanh_distort(v, ratio=0.5):
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def update(self, values):
+        """
+        Publish a new version with `values` applied.
+        """
+        with self._lock:
+            current = self._snapshot
+            new_values = dict(current._values)
+            new_values.update(values)
+            self._snapshot = ParamSnapshot(new_values, current.version + 1)
+
+    def __getitem__(self, key):
+        return self._snapshot[key]
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+
+class AllocationCheck:
+    """
+    Debug wrapper for the chunk processor that counts the objects each
+    chunk allocates once the stream has settled, and logs every chunk that
+    allocates any, or that goes over `budget` bytes as measured with
+    tracemalloc.
+
+    The count is the change of the garbage collector's generation 0 count,
+    with collection held off during the chunk, so it sees every container
+    object the chunk creates and does not free again, which a steady audio
+    path never does. Objects freed within the chunk, like floats boxed in a
+    per sample loop, cancel out of it; those still raise the tracemalloc
+    peak. Views and numpy scalars cost a few hundred bytes of object
+    headers per chunk, which the budget allows for. Any buffer of chunk
+    size allocated on the audio path will not fit in it.
+
+    tracemalloc counts the allocations of every thread, so the check is
+    only meaningful with no other busy thread in the process, which is
+    why it needs --render or --gui-process.
     """
-    Exponential distortion function.
 
-    Parameters
-    ----------
-    x : ndarray of sample positions
-    rate : rate of distortion in samples
+    def __init__(self, process, budget=4096, warmup=16, report_every=1000):
+        self.process = process
+        self.budget = budget
+        self.warmup = warmup
+        self.report_every = report_every
+        self.chunks = 0
+        self.over = 0
+        self.worst = 0
+        self.worst_count = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __call__(self, data):
+        collecting = gc.isenabled()
+        gc.disable()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = gc.get_count()[0]
+        try:
+            result = self.process(data)
+        finally:
+            count = gc.get_count()[0] - objects
+            allocated = tracemalloc.get_traced_memory()[1] - before
+            if collecting:
+                gc.enable()
+
+        self.chunks += 1
+        if self.chunks <= self.warmup:
+            return result
+
+        self.worst = max(self.worst, allocated)
+        self.worst_count = max(self.worst_count, count)
+        if count > 0 or allocated > self.budget:
+            self.over += 1
+            logging.warning(
+                f"Chunk {self.chunks} allocated {count} objects and "
+                f"{allocated} bytes, budget {self.budget} bytes")
+        if (self.chunks - self.warmup) % self.report_every == 0:
+            logging.info(
+                f"Allocation check: {self.over} of "
+                f"{self.chunks - self.warmup} chunks allocated, "
+                f"worst {self.worst_count} objects, {self.worst} bytes")
+        return result
+
+
+def load_filter():
+    """
+    Loads the FIR coefficients named by options['filter'], a path or the
+    name of a file in Resources, taking row options['filter_coef'] if it
+    holds several filters
 
     Returns
     -------
-    ndarray of values 0-1, for relative distortion
+    read-only ndarray of coefficients, cached after the first call
+    """
+    path = options['filter']
+    if not os.path.exists(path):
+        path = os.path.join(RESOURCES, path)
+    coefficients = load_coefficients(path, options['filter_coef'])
+    if coefficients.size != options['filter_order'] + 1:
+        logging.warning(f"{options['filter']} has {coefficients.size} taps, "
+                        f"expected a {options['filter_type']} filter of order "
+                        f"{options['filter_order']}")
+    return coefficients
+
+
+@functools.lru_cache(maxsize=None)
+def load_impulse_response(path, framerate):
     """
-    return np.tanh(v) * ratio * np.sin(v)
+    Loads an impulse response for the convolution reverb, from the first
+    channel of a PCM wav file or from anything load_coefficients reads. A
+    bare file name is looked up in Resources.
 
+    A wav file at another rate is resampled to `framerate`. The response
+    is scaled to unit energy, so the reverb is about as loud as the dry
+    signal whatever the length of the room.
 
-def clip_distort(v, ratio):
+    Returns
+    -------
+    ndarray of the impulse response, cached per file and rate
     """
-    Clips values to a maximum
+    if not os.path.exists(path):
+        path = os.path.join(RESOURCES, path)
+    if path.endswith('.wav'):
+        wav = MappedWav(path)
+        response = wav.frames[:, 0].astype(float)
+        rate = wav.rate
+        wav.close()
+        if rate != framerate:
+            resampler = Resampler(rate, framerate)
+            # the zeros push the end of the response out of the filter
+            response = resampler.process(
+                np.concatenate([response, np.zeros(resampler.taps)]))
+    else:
+        response = np.array(load_coefficients(path))
+
+    energy = np.sqrt(np.sum(response ** 2))
+    if energy == 0:
+        raise ValueError(f"{path} is silent")
+    response /= energy
+    response.flags.writeable = False
+    return response
+
+
+def make_processor(config: AtomicDict, input_channels=1, framerate=None):
     """
-    return np.where(np.abs(ratio * v) > 1, 1, v * ratio)
+    Builds the per-chunk effect processor used by every stream mode
 
+    Parameters
+    ----------
+    config : dictionary of configuration parameters, see play_audio
+    input_channels : number of interleaved channels in the input data,
+        only the first one is processed
+    framerate : sample rate of the data, defaults to options['framerate']
 
-def play_audio(config: AtomicDict, raise_exception):
+    Returns
+    -------
+    function taking a chunk of int16 input bytes and returning the
+    interleaved int16 output samples, keeping the effect state between
+    calls. The returned array is overwritten by the next call.
+    """
+
+    effects = config['effects']
+    if framerate is None:
+        framerate = options['framerate']
+
+    stages = [
+        Dynamics(),
+        ClipDistort(),
+        TanhDistort(),
+        Delay(),
+        Flanger(),
+        Reverb(),
+        Tremolo(),
+    ]
+    # after the comb reverb, before the tremolo
+    if options['impulse_response']:
+        stages.insert(-1, Convolution(
+            load_impulse_response(options['impulse_response'], framerate)))
+    # the coefficients, and scipy for .mat files, are only loaded when the
+    # filter is used
+    if effects['filter_enabled']:
+        stages.insert(0, Filter(load_filter()))
+    chain = Chain(stages, config['chunk'], framerate)
+
+    arena = BufferArena(config['chunk'], options['channels'], input_channels)
+    output = StereoOutput(arena, framerate)
+
+    # per stage timings go to the metrics and the profiler, if enabled
+    metrics = config['metrics']
+    profiler = config['profile']
+    observers = []
+    if metrics is not None:
+        metrics.prepare(config['chunk'], framerate)
+        observers.append(metrics.stage)
+    if profiler is not None:
+        observers.append(profiler.record)
+
+    observer = None
+    if len(observers) == 1:
+        observer = observers[0]
+    elif observers:
+        def observer(name, start, end):
+            for each in observers:
+                each(name, start, end)
+    chain.observer = output.observer = observer
+
+    def normalize(data):
+        inputs = arena.load(data)
+
+        # scale to full scale straight into the chain's working buffer,
+        # converting to float first as a mixed type multiply allocates a
+        # cast buffer. The compressor stage does the level control
+        buffer = chain.block(inputs.size)
+        np.copyto(buffer, inputs)
+        buffer *= 1 / 32768
+        return buffer
+
+    write_input = config['input_array'].write
+    interleave = output.process
+    if observer is not None:
+        normalize = observed(observer, 'normalization', normalize)
+        write_input = observed(observer, 'ring_write', write_input)
+        interleave = observed(observer, 'interleave', interleave)
+
+    def process(data):
+        # take one snapshot of the effect values per chunk, so a slider
+        # moving mid-chunk can't leave a mix of old and new values
+        params = effects.snapshot()
+
+        buffer = normalize(data)
+        write_input(buffer)
+        chain.process(buffer, params)
+        return interleave(buffer, params, config['array'])
+
+    if metrics is not None:
+        process = metrics.timed(process)
+    if profiler is not None:
+        process = observed(profiler.record, 'process', process)
+    if config['alloc_check'] is not None:
+        return AllocationCheck(process, budget=config['alloc_check'])
+    return process
+
+
+def play_audio(config: AtomicDict, raise_exception, backends=None):
     """
         Plays an audio file
 
@@ -125,170 +367,318 @@ def play_audio(config: AtomicDict, raise_exception):
         ----------
         config : dictionary of configuration parameters
             - filename : string
-                path to the audio file to be played
+                source to play instead of the input device, a wav file,
+                'sine[:<freq>]' or 'noise'
+            - output : string
+                sink to play to instead of the output device, a wav
+                file or 'null'
             - device : int
                 device index to be used for playback
-            - volume : float
-                volume of the audio file to be played
+            - input : int
+                device index to be used for recording
             - channels : int
                 number of channels of the audio file to be played
-            - rate : int
-                sampling rate of the audio file to be played
+            - rate : int or None
+                sample rate the effects run at, the source's own rate if
+                None
+            - device_rate : int or None
+                sample rate the sound card streams are opened at, the
+                effects rate if None
             - chunk : int
-                size of the chunks of the audio file to be played
-            - duration : float - NOT USED
-                duration of the audio file to be played
-            - array: AtomicArray
-                array to append chunk data to
-            - effects: dict
-                dictionary of effects to be applied to the audio file
+                size of the chunks of the audio file to be played, also
+                used as the stream buffer size
+            - duplex : bool
+                if True, run a single callback driven duplex stream
+            - fps : float
+                highest rate the plots are redrawn at
+            - alloc_check : int or None
+                if set, log chunks that allocate more than this many bytes
+            - metrics : Metrics or None
+                if set, records chunk and stage timings, xruns and the
+                input queue depth
+            - profile : SpanRecorder or None
+                if set, records a span for every stage of every chunk
+            - duration : float
+                length of a generated source in seconds, 0 for endless
+            - array: RingBuffer
+                buffer to write output chunk data to
+            - input_array: RingBuffer
+                buffer to write input chunk data to
+            - effects: ParamStore
+                effect parameters and volume, read once per chunk
 
         raise_exception : function
             if True, will halt the thread
+        backends : (source, sink) already opened by open_backends, or
+            None to open them here
 
         Returns
         -------
         nothing
         """
 
-    framerate = options['framerate']
+    if config['duplex']:
+        play_audio_duplex(config, raise_exception)
+        return
 
-    p = pyaudio.PyAudio()
+    chunk = config['chunk']
+    source, sink = backends or open_backends(config)
+    process = make_processor(config, input_channels=source.channels,
+                             framerate=source.rate)
 
-    stream = p.open(
-        format=options['format'],
-        channels=options['channels'],
-        rate=options['framerate'],
-        output=True,
-        output_device_index=config['device']
-    )
+    metrics = config['metrics']
+    read, write = source.read, sink.write
+    if config['profile'] is not None:
+        read = observed(config['profile'].record, 'stream.read', read)
+        write = observed(config['profile'].record, 'stream.write', write)
 
-    in_stream = p.open(
-        format=options['format'],
-        channels=options['input_channels'],
-        rate=options['framerate'],
-        input=True,
-        output_device_index=config['input']
-    )
+    data = read(chunk)
 
-    data = in_stream.read(config['chunk'])
+    # for i in range(config['num_chunks']):
+    while len(data) > 0:
+        write(process(data))
 
-    last_max = options['default_volume']
+        if metrics is not None:
+            metrics.poll(source, sink)
 
-    M = int(config['effects']['delay_secs'] * options['framerate'])
-    D = np.zeros(5 * options['framerate'])
-    ptr = 0
+        if raise_exception():
+            raise Exception("InteruptException in playback thread")
 
-    def delayline(x, ptr):
-        y = D[ptr]
-        D[ptr] = x
-        ptr = (ptr + 1) % M
-        return y, ptr
+        # read the next chunk of data from the file
+        data = read(chunk)
 
-    Mr = int(config['effects']['reverb_secs'] * options['framerate'])
-    R = np.zeros(5 * options['framerate'])
-    ptrr = 0
+    logging.info("* done *")
 
-    def reverbline(x, ptr):
-        y = R[ptr]
-        R[ptr] = x + config['effects']['reverb_falloff']*y
-        ptr = (ptr + 1) % Mr
-        return y, ptr
+    source.close()
+    sink.close()
 
-    # Mf = int(framerate * (80/1000)) # max delay
-    # Mfmin = int(framerate * (40/1000)) # min delay
-    # F = np.zeros(Mf)
-    # Fptr = 0
-    # Fmod = Mf//2
-    # fCount = 0
 
-    # def flangeline(x, ptr, m):
-    #     y = F[ptr]
-    #     F[ptr] = x
-    #     ptr = (ptr + 1) % m
-    #     return y, ptr
+def open_backends(config: AtomicDict, source_spec=None, sink_spec=None):
+    """
+    Opens the source and sink for the effects
 
-    # for i in range(config['num_chunks']):
-    while 1:
-        # read effect values
-        # helps prevent thread collisions if read only once
-        fade = config['effects']['fade']
-        volume = config['volume']
-        clip_distort_v = config['effects']['clip_distort']
+    Parameters
+    ----------
+    config : dictionary of configuration parameters, see play_audio
+    source_spec : source description, see backends.open_source, defaults
+        to config['filename'] or the input device
+    sink_spec : sink description, see backends.open_sink, defaults to
+        config['output'] or the output device
+
+    Returns
+    -------
+    (source, sink) backends, both at the rate the effects run at. Either
+    is resampled when its own rate is different.
+    """
+    chunk = config['chunk']
+    duration = config['duration'] or None
+    rate = config['rate']
+    device_rate = config['device_rate'] or rate or options['framerate']
+
+    source = open_source(source_spec or config['filename'], device_rate,
+                         options['input_channels'], options['sample_width'],
+                         device=config['input'], frames_per_buffer=chunk,
+                         duration=duration)
+    if source.sample_width != 2:
+        source.close()
+        raise ValueError("The effects need 16 bit input")
+    rate = rate or source.rate
+    if source.rate != rate:
+        logging.info(f"Resampling the input from {source.rate} to {rate} Hz")
+        source = ResampledSource(source, rate)
+
+    sink_spec = sink_spec or config['output'] or 'speaker'
+    sink = open_sink(sink_spec, device_rate if sink_spec == 'speaker' else rate,
+                     options['channels'], options['sample_width'],
+                     device=config['device'], frames_per_buffer=chunk)
+    if sink.rate != rate:
+        logging.info(f"Resampling the output from {rate} to {sink.rate} Hz")
+        sink = ResampledSink(sink, rate)
+    return source, sink
+
+
+class LatencyMeter:
+    """
+    Tracks the input to output latency reported by PortAudio for every
+    callback, as the time the output reaches the DAC minus the time the
+    input left the ADC.
+    """
 
-        M = int(config['effects']['delay_secs'] * options['framerate'])
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, time_info):
+        latency = time_info['output_buffer_dac_time'] - \
+            time_info['input_buffer_adc_time']
+        # some host APIs don't fill in the timestamps
+        if latency <= 0:
+            return
+        self.count += 1
+        self.total += latency
+        self.min = min(self.min, latency)
+        self.max = max(self.max, latency)
+
+    def report(self):
+        if self.count == 0:
+            return "no timestamps reported by the host API"
+        return (f"mean {1000 * self.total / self.count:.2f} ms, "
+                f"min {1000 * self.min:.2f} ms, max {1000 * self.max:.2f} ms "
+                f"over {self.count} buffers")
+
+
+def duplex_rate(config: AtomicDict):
+    """
+    Sample rate of the duplex stream, which the effects run at too: one
+    stream means one rate, there is nothing to resample between
+    """
+    return config['device_rate'] or config['rate'] or options['framerate']
 
-        # read data from buffer into a mutable numpy array
-        inputs = np.frombuffer(data, dtype=np.int16)
 
-        max_value = np.max(np.abs(inputs))
-        if max_value > last_max:
-            last_max = max_value
-        else:
-            last_max = (last_max * (1 - config['effects']['volume_roll_rate'])) + (
-                max_value * config['effects']['volume_roll_rate'])
+def open_stream(config: AtomicDict):
+    """
+    Opens the backends of a blocking stream, before the plots are built so
+    they can be labelled with the rate the effects actually run at
 
-        inputs = inputs / last_max
+    Returns
+    -------
+    (backends, framerate), backends being None for a duplex stream, which
+    play_audio_duplex opens itself
+    """
+    if config['duplex']:
+        return None, duplex_rate(config)
+    backends = open_backends(config)
+    return backends, backends[0].rate
 
-        config['input_array'].append(inputs)
 
-        buffer = inputs.copy()
+def play_audio_duplex(config: AtomicDict, raise_exception):
+    """
+        Runs the effects on one full-duplex stream driven by a PortAudio
+        callback, the same model C/effects.c uses
 
-        # distort the output
-        if clip_distort_v > 0:
-            buffer = clip_distort(buffer, clip_distort_v)
+        Parameters
+        ----------
+        config : dictionary of configuration parameters, see play_audio
+        raise_exception : function
+            if True, will stop the stream
 
-        if M > 0:
-            for i in range(len(buffer)):
-                v, ptr = delayline(buffer[i], ptr)
-                buffer[i] += config['effects']['delay_amplitude'] * v + \
-                    (1 - config['effects']['delay_amplitude']) * buffer[i]
+        Returns
+        -------
+        nothing
+        """
 
-        if Mr > 0:
-            for i in range(len(buffer)):
-                v, ptrr = reverbline(buffer[i], ptrr)
-                buffer[i] += config['effects']['reverb_amplitude'] * v + \
-                    (1 - config['effects']['reverb_amplitude']) * buffer[i]
+    import pyaudio
 
-        buffer = np.repeat(buffer, 2).copy()
+    chunk = config['chunk']
+    rate = duplex_rate(config)
 
-        # isolates the left channel. [::2] will take every other element, starting at 0
-        left = buffer[::2]
-        # isolates the right channel. [1::2] will take every other element, starting at 1
-        right = buffer[1::2]
+    # a duplex stream has one channel count for both directions, so the
+    # input is opened with the output channels and only the first is used
+    process = make_processor(config, input_channels=options['channels'],
+                             framerate=rate)
+    latency = LatencyMeter()
+    metrics = config['metrics']
 
-        # multiply the left and right channels by the fade value
-        if fade != 0.5:
-            left = left * (1 - fade)
-            right = right * fade
+    def callback(in_data, frame_count, time_info, status):
+        latency.add(time_info)
+        if metrics is not None and status:
+            if status & pyaudio.paInputOverflow:
+                metrics.overflow()
+            if status & pyaudio.paOutputUnderflow:
+                metrics.underflow()
+        return (process(in_data).tobytes(), pyaudio.paContinue)
 
-        # recombine the left and right channels
-        buffer = np.empty((left.size + right.size,), dtype=right.dtype)
-        buffer[0::2] = left
-        buffer[1::2] = right
+    p = pyaudio.PyAudio()
 
-        config['array'].append(buffer)
+    stream = p.open(
+        format=p.get_format_from_width(options['sample_width']),
+        channels=options['channels'],
+        rate=rate,
+        input=True,
+        output=True,
+        input_device_index=config['input'],
+        output_device_index=config['device'],
+        frames_per_buffer=chunk,
+        stream_callback=callback
+    )
 
-        buffer *= volume
-        # buffer tobytes() will convert the now mutated buffer array back to a python bytes object
-        # stream.write() will play the entire buffer (chunksize bytes)
-        stream.write(buffer.astype(np.int16, copy=False).tobytes())
+    logging.info(
+        f"Duplex stream open with {chunk} frames per buffer "
+        f"({1000 * chunk / rate:.2f} ms), reported latency "
+        f"{1000 * (stream.get_input_latency() + stream.get_output_latency()):.2f} ms")
 
-        if raise_exception():
-            raise Exception("InteruptException in playback thread")
+    stream.start_stream()
 
-        # read the next chunk of data from the file
-        data = in_stream.read(config['chunk'])
+    last_report = time.time()
+    while stream.is_active() and not raise_exception():
+        time.sleep(0.1)
+        if time.time() - last_report > 5:
+            logging.info(f"Measured latency: {latency.report()}")
+            last_report = time.time()
 
+    logging.info(f"Measured latency: {latency.report()}")
     logging.info("* done *")
 
     stream.stop_stream()
     stream.close()
-    in_stream.stop_stream()
-    in_stream.close()
     p.terminate()
 
 
+def render(config: AtomicDict, source_spec, sink_spec):
+    """
+    Runs the effect chain from a source to a sink as fast as they allow
+
+    The input is read and the output written one chunk at a time, so
+    memory use doesn't depend on the length of the input. Rendering a wav
+    file or a generated signal into a wav file or the null sink needs no
+    audio device.
+
+    Parameters
+    ----------
+    config : dictionary of configuration parameters, see play_audio
+    source_spec : 16 bit wav file, 'sine[:<freq>]', 'noise' or 'mic',
+        only the first channel is used
+    sink_spec : wav file to write, 'null' or 'speaker'
+
+    Returns
+    -------
+    number of frames rendered
+    """
+    chunk = config['chunk']
+
+    source, sink = open_backends(config, source_spec, sink_spec)
+    process = make_processor(config, input_channels=source.channels,
+                             framerate=source.rate)
+
+    read, write = source.read, sink.write
+    if config['profile'] is not None:
+        read = observed(config['profile'].record, 'stream.read', read)
+        write = observed(config['profile'].record, 'stream.write', write)
+
+    frames = 0
+    start = time.perf_counter()
+    try:
+        data = read(chunk)
+        while len(data) > 0:
+            write(process(data))
+            frames += len(data) // (2 * source.channels)
+            data = read(chunk)
+    except KeyboardInterrupt:
+        logging.info("Interupted by user")
+    finally:
+        source.close()
+        sink.close()
+    elapsed = time.perf_counter() - start
+
+    logging.info(
+        f"Rendered {frames} frames in {elapsed:.3f} s: "
+        f"{frames / elapsed:.0f} samples/s, "
+        f"{frames / source.rate / elapsed:.1f}x real time")
+    return frames
+
+
 def subsample(array, factor, method='mean'):
     """
     Subsample an array by a factor. Using the given method
@@ -301,31 +691,39 @@ def subsample(array, factor, method='mean'):
         raise ValueError('Method not supported')
 
 
-def run(config, data_array, input_array):
-    global raise_exception
-    raise_exception = False
-
-    def handle_close_event(event):
-        global raise_exception
-        raise_exception = True
+def build_gui(params, data_array, input_array, on_change, fps, spectrum=False,
+              framerate=None, chunk=1024):
+    """
+    Builds the plot window and effect sliders
 
-    def raise_exception_func():
-        global raise_exception
-        return raise_exception
+    Parameters
+    ----------
+    params : mapping of effect values to start the sliders at
+    data_array : RingBuffer of output frames
+    input_array : RingBuffer of input samples
+    on_change : function called with the effect name and new value when
+        a slider moves
+    fps : highest rate to redraw the plots at
+    spectrum : also show the spectrum and spectrogram of the left output
+    framerate : sample rate of the output, for the frequency axis
+    chunk : frames the audio thread writes at a time
 
-    fig, ax = plt.subplots(1, 2, figsize=(8, 4))
+    Returns
+    -------
+    the figure, its PlotRenderer and the sliders, which have to be kept
+    alive for their callbacks to work
+    """
+    if spectrum:
+        fig, axes = plt.subplots(2, 2, figsize=(8, 7))
+        ax, spec_ax = axes
+    else:
+        fig, ax = plt.subplots(1, 2, figsize=(8, 4))
     fig.tight_layout(pad=3)
 
     plt.subplots_adjust(bottom=0.4)
 
-    fig.canvas.mpl_connect('close_event', handle_close_event)
-
-    playback_thread = threading.Thread(target=play_audio, args=(
-        config, raise_exception_func), daemon=True)
-
-    sliding_window_size = 48000
+    sliding_window_size = options['plot_window']
     window_subsample_rate = 16
-    plot_sample_rate = 60
 
     ax[1].set_xlabel('Frames')
     ax[1].set_ylabel('Amplitude')
@@ -339,14 +737,46 @@ def run(config, data_array, input_array):
     ax[0].set_ylim([-1, 1])
     ax[0].set_xlim([0, sliding_window_size//(2*window_subsample_rate)])
 
-    plot_points_left = ax[1].plot(
-        np.arange(sliding_window_size//2), np.zeros(sliding_window_size//2), c='b', label='Left')[0]
-    plot_points_right = ax[1].plot(
-        np.arange(sliding_window_size//2), np.zeros(sliding_window_size//2), c='r', label='Right')[0]
+    plot_points_left = ax[1].plot([], [], c='b', label='Left')[0]
+    plot_points_right = ax[1].plot([], [], c='r', label='Right')[0]
     ax[1].legend()
 
-    plot_points_input = ax[0].plot(np.arange(
-        sliding_window_size//2), np.zeros(sliding_window_size//2), c='g', label='Input')[0]
+    plot_points_input = ax[0].plot([], [], c='g', label='Input')[0]
+
+    # both plots show the same stretch of time, the output is interleaved
+    # stereo so it holds two samples per frame
+    frames = sliding_window_size // 2
+    renderer = PlotRenderer(fig, fps=fps)
+    renderer.add(ax[1], Trace(plot_points_left, data_array, frames,
+                              window_subsample_rate, channels=2, channel=0, offset=1))
+    renderer.add(ax[1], Trace(plot_points_right, data_array, frames,
+                              window_subsample_rate, channels=2, channel=1, offset=-1))
+    renderer.add(ax[0], Trace(plot_points_input, input_array, frames,
+                              window_subsample_rate))
+
+    if spectrum:
+        framerate = framerate or options['framerate']
+        columns = 256
+
+        spec_ax[0].set_xlabel('Frequency (Hz)')
+        spec_ax[0].set_ylabel('Level (dB)')
+        spec_ax[0].set_title('Output Spectrum')
+        spec_ax[0].set_xlim([0, framerate / 2])
+        spec_ax[0].set_ylim([-100, 10])
+        spectrum_line = spec_ax[0].plot([], [], c='b')[0]
+
+        spec_ax[1].set_xlabel('Windows')
+        spec_ax[1].set_ylabel('Frequency (Hz)')
+        spec_ax[1].set_title('Output Spectrogram')
+        spectrogram_image = spec_ax[1].imshow(
+            np.zeros((2, columns)), aspect='auto', origin='lower',
+            extent=[0, columns, 0, framerate / 2], vmin=-100, vmax=0)
+
+        spectrogram = Spectrogram(data_array, framerate, spectrum_line,
+                                  spectrogram_image, columns=columns,
+                                  channels=2, channel=0, headroom=chunk)
+        renderer.add(spec_ax[0], spectrogram)
+        renderer.add(spec_ax[1], spectrogram)
 
     vol_ax = plt.axes([0.11, 0.05, 0.30, 0.03])
     fader_ax = plt.axes([0.11, 0.10, 0.30, 0.03])
@@ -357,28 +787,24 @@ def run(config, data_array, input_array):
     reverb_amplitude_ax = plt.axes([0.60, 0.05, 0.30, 0.03])
 
     vol_slider = widgets.Slider(
-        vol_ax, 'Volume', valinit=config['volume'], valmin=options['min_volume'], valmax=options['max_volume'], valstep=1000)
+        vol_ax, 'Volume', valinit=params['volume'], valmin=options['min_volume'], valmax=options['max_volume'], valstep=1000)
     fader_slider = widgets.Slider(
-        fader_ax, 'Fade Side', valinit=config['effects']['fade'], valmin=0, valmax=1, valstep=0.1)
+        fader_ax, 'Fade Side', valinit=params['fade'], valmin=0, valmax=1, valstep=0.1)
     clip_distort_slider = widgets.Slider(
-        clip_distort_ax, 'Clip Distort', valinit=config['effects']['clip_distort'], valmin=0, valmax=10)
+        clip_distort_ax, 'Clip Distort', valinit=params['clip_distort'], valmin=0, valmax=10)
     delay_slider = widgets.Slider(
-        delay_ax, 'Delay', valinit=config['effects']['delay_secs'], valmin=0, valmax=5, valstep=0.1)
+        delay_ax, 'Delay', valinit=params['delay_secs'], valmin=0, valmax=5, valstep=0.1)
     delay_amp_slider = widgets.Slider(
-        delay_amplitude_ax, 'Delay Amp', valinit=config['effects']['delay_amplitude'], valmin=0, valmax=1, valstep=0.1)
+        delay_amplitude_ax, 'Delay Amp', valinit=params['delay_amplitude'], valmin=0, valmax=1, valstep=0.1)
 
     reverb_slider = widgets.Slider(
-        reverb_ax, 'Reverb', valinit=config['effects']['reverb_secs'], valmin=0, valmax=2, valstep=0.05)
+        reverb_ax, 'Reverb', valinit=params['reverb_secs'], valmin=0, valmax=2, valstep=0.05)
     reverb_amp_slider = widgets.Slider(
-        reverb_amplitude_ax, 'Reverb Falloff', valinit=config['effects']['reverb_falloff'], valmin=0, valmax=1)
+        reverb_amplitude_ax, 'Reverb Falloff', valinit=params['reverb_falloff'], valmin=0, valmax=1)
 
-    def update(effect, is_effect=True):
+    def update(effect):
         def update_func(val):
-            if is_effect:
-                config['effects'][effect] = val
-            else:
-                config[effect] = val
-            logging.info(f"Updated {effect} to {val}")
+            on_change(effect, val)
         return update_func
 
     fader_slider.on_changed(update('fade'))
@@ -387,62 +813,54 @@ def run(config, data_array, input_array):
     delay_amp_slider.on_changed(update('delay_amplitude'))
     reverb_slider.on_changed(update('reverb_secs'))
     reverb_amp_slider.on_changed(update('reverb_falloff'))
-    vol_slider.on_changed(update('volume', False))
+    vol_slider.on_changed(update('volume'))
 
-    plt.ion()
-    plt.show()
-    plt.pause(0.1)
-
-    data_array.append(np.zeros(sliding_window_size))
-
-    time.sleep(0.5)
-    playback_thread.start()
+    sliders = [vol_slider, fader_slider, clip_distort_slider, delay_slider,
+               delay_amp_slider, reverb_slider, reverb_amp_slider]
 
-    # cache background
-    background = fig.canvas.copy_from_bbox(ax[0].bbox)
+    return fig, renderer, sliders
 
-    fft_max = 0
 
-    try:
-        while playback_thread.is_alive():
-            # update the data
-            all_data = data_array.get()
-            window_data = all_data[-sliding_window_size:]
+def run(config, data_array, input_array):
+    global raise_exception
+    raise_exception = False
 
-            window_data_left = subsample(
-                window_data[::2], window_subsample_rate)
+    def handle_close_event(event):
+        global raise_exception
+        raise_exception = True
 
-            window_data_right = subsample(
-                window_data[1::2], window_subsample_rate)
+    def raise_exception_func():
+        global raise_exception
+        return raise_exception
 
-            # amplitude plots
-            plot_points_left.set_data(
-                np.arange(window_data_left.shape[0]), window_data_left+1)
+    def update(effect, val):
+        config['effects'][effect] = val
+        logging.info(f"Updated {effect} to {val}")
 
-            plot_points_right.set_data(
-                np.arange(window_data_right.shape[0]), window_data_right-1)
+    backends, framerate = open_stream(config)
+    fig, renderer, sliders = build_gui(config['effects'].snapshot(), data_array,
+                                       input_array, update, config['fps'],
+                                       config['spectrum'], framerate,
+                                       config['chunk'])
 
-            # update input data
-            in_data = input_array.get()
-            window_in_data = in_data[-sliding_window_size:]
-            window_in_data = subsample(window_in_data, window_subsample_rate)
+    fig.canvas.mpl_connect('close_event', handle_close_event)
 
-            plot_points_input.set_data(
-                np.arange(window_in_data.shape[0]), window_in_data)
+    playback_thread = threading.Thread(target=play_audio, args=(
+        config, raise_exception_func, backends), daemon=True)
 
-            # shorten data arrays
-            if in_data.shape[0] > sliding_window_size * 2:
-                data_array.remove(np.s_[:sliding_window_size])
-                input_array.remove(np.s_[:sliding_window_size])
+    plt.ion()
+    plt.show()
+    plt.pause(0.1)
 
-            # rebuild plot
-            fig.canvas.restore_region(background)
-            ax[1].draw_artist(plot_points_left)
-            ax[1].draw_artist(plot_points_right)
-            ax[0].draw_artist(plot_points_input)
-            fig.canvas.blit(ax[0].bbox)
+    time.sleep(0.5)
+    playback_thread.start()
 
-            # plt.pause(1/plot_sample_rate)
+    try:
+        while playback_thread.is_alive():
+            # sleep until the next frame, then redraw only if the audio
+            # thread has written anything since the last one
+            renderer.wait()
+            renderer.draw()
     except KeyboardInterrupt:
         raise_exception = True
         logging.info("Interupted by user")
@@ -452,65 +870,289 @@ def run(config, data_array, input_array):
     # wait for the playback thread to finish
     playback_thread.join()
 
-    logging.info(len(data_array.get()))
+    logging.info(data_array.count)
+
+
+def gui_process(params, names, capacity, fps, conn, stop, spectrum=False,
+                framerate=None, chunk=1024):
+    """
+    Entry point of the plotting process started by run_gui_process
+
+    Parameters
+    ----------
+    params : dictionary of effect values to start the sliders at
+    names : shared memory names of the output and input ring buffers
+    capacity : capacity of the ring buffers
+    fps : highest rate to redraw the plots at
+    conn : Connection to send (effect, value) slider changes on, and None
+        when the window is closed
+    stop : Event set by the audio process when playback ends
+    spectrum, framerate, chunk : passed on to build_gui
+    """
+    data_array = RingBuffer.attach(names[0], capacity)
+    input_array = RingBuffer.attach(names[1], capacity)
+    closed = False
+
+    def handle_close_event(event):
+        nonlocal closed
+        closed = True
+
+    def update(effect, val):
+        conn.send((effect, val))
+
+    fig, renderer, sliders = build_gui(params, data_array, input_array,
+                                       update, fps, spectrum, framerate,
+                                       chunk)
+    fig.canvas.mpl_connect('close_event', handle_close_event)
+
+    plt.ion()
+    plt.show()
+    plt.pause(0.1)
+
+    try:
+        while not closed and not stop.is_set():
+            renderer.wait()
+            renderer.draw()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        conn.close()
+        plt.close(fig)
+        data_array.close()
+        input_array.close()
+
+
+def run_gui_process(config, data_array, input_array):
+    """
+    Runs the audio in this process and the plots and sliders in a child
+    process, so drawing never holds the GIL the audio thread needs
+
+    The waveforms reach the child through the shared memory ring buffers,
+    which must have been made with RingBuffer.shared. Slider changes come
+    back over a pipe and are published to config['effects'] by a listener
+    thread.
+    """
+    backends, framerate = open_stream(config)
+    ctx = multiprocessing.get_context('spawn')
+    receiver, sender = ctx.Pipe(duplex=False)
+    stop = ctx.Event()
+
+    gui = ctx.Process(target=gui_process, args=(
+        dict(config['effects'].snapshot()),
+        (data_array.shm.name, input_array.shm.name),
+        data_array.capacity, config['fps'], sender, stop,
+        config['spectrum'], framerate, config['chunk']), daemon=True)
+    gui.start()
+    sender.close()
+
+    def listen():
+        try:
+            while True:
+                message = receiver.recv()
+                if message is None:
+                    break
+                effect, val = message
+                config['effects'][effect] = val
+                logging.info(f"Updated {effect} to {val}")
+        except EOFError:
+            pass
+        stop.set()
+
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+
+    try:
+        play_audio(config, stop.is_set, backends)
+    except KeyboardInterrupt:
+        logging.info("Interupted by user")
+    except Exception:
+        # play_audio raises when it is told to stop
+        if not stop.is_set():
+            raise
+    finally:
+        stop.set()
+        gui.join(timeout=5)
+        if gui.is_alive():
+            gui.terminate()
+        receiver.close()
+        data_array.close(unlink=True)
+        input_array.close(unlink=True)
 
 
 def main(argv):
-    data_array = AtomicArray(0)
-    input_array = AtomicArray(0)
+    # twice the plotted window, so the writer has room before it laps
+    # the window the plot is reading
+    data_array = RingBuffer(2 * options['plot_window'])
+    input_array = RingBuffer(2 * options['plot_window'])
 
     config = {
         'filename': '',
+        'output': '',
         'device': 0,
         'input': 0,
-        'volume': options['default_volume'],
         'chunk': 1024,
-        'frame_rate': 44100,
+        'duplex': False,
+        'fps': 30,
+        'gui_process': False,
+        'spectrum': False,
+        'alloc_check': None,
+        'metrics': None,
+        'profile': None,
+        'rate': None,
+        'device_rate': None,
         'duration': 0,
         'array': data_array,
         'input_array': input_array,
     }
     config = AtomicDict(config)
 
-    config['effects'] = AtomicDict()
-    config['effects']['volume_roll_rate'] = 0.0001
-    config['effects']['fade'] = 0.5
-    config['effects']['delay_secs'] = 0
-    config['effects']['delay_amplitude'] = 0.5
-
-    config['effects']['clip_distort'] = 0.0
-    config['effects']['reverb_secs'] = 0.5
-    config['effects']['reverb_falloff'] = 0.5
-    config['effects']['reverb_amplitude'] = 0.5
+    config['effects'] = ParamStore({
+        'volume': options['default_volume'],
+        'filter_enabled': False,
+        'compressor_threshold': 0.1,
+        'compressor_ratio': np.inf,
+        'compressor_attack': 0.005,
+        'compressor_release': 0.25,
+        'fade': 0.5,
+        'pan_rate': 0.0,
+        'pan_depth': 1.0,
+        'pan_shape': 'sine',
+        'tremolo_rate': 0.0,
+        'tremolo_depth': 0.5,
+        'tremolo_shape': 'sine',
+        'flanger_mix': 0.0,
+        'flanger_rate': 0.25,
+        'flanger_shape': 'sine',
+        'flanger_min_secs': 0.04,
+        'flanger_max_secs': 0.08,
+        'flanger_feedback': 0.0,
+        'convolution_mix': 0.3,
+        'delay_secs': 0,
+        'delay_amplitude': 0.5,
+
+        'clip_distort': 0.0,
+        'tanh_distort': 0.0,
+        'reverb_secs': 0.5,
+        'reverb_falloff': 0.5,
+        'reverb_amplitude': 0.5,
+    })
+
+    usage = 'statsplay.py -f <inputfile|sine[:freq]|noise> -o <outputfile|null> -d <device_index> -i <input_index> -v <volume> -b <buffer_frames> -t <secs> [--fps <plot_fps>] [--spectrum] [--gui-process] [--duplex] [--alloc-check <budget_bytes>] [--metrics <port|file>] [--profile <trace.json|stacks.txt>] [--pan <hz>[:<shape>]] [--tremolo <hz>[:<shape>]] [--flanger <mix>] [--rate <hz>] [--device-rate <hz>] [--filter <coefficients.mat|.npy|.txt>] [--ir <response.wav|.npy>]'
+    usage_render = 'statsplay.py --render <in.wav|sine[:freq]|noise|mic> <out.wav|null|speaker> -b <buffer_frames> -t <secs>'
+    render_files = None
+    metrics_target = None
+    profile_path = None
 
     try:
-        opts, args = getopt.getopt(
-            argv, "hi:d:v:f:", ["file=", "device=", "volume=", "input="])
+        # options can come after the --render files
+        opts, args = getopt.gnu_getopt(
+            argv, "hi:d:v:f:o:b:t:", ["file=", "output=", "device=", "volume=", "input=", "buffer=", "duration=", "fps=", "spectrum", "gui-process", "duplex", "render", "alloc-check=", "metrics=", "profile=", "pan=", "tremolo=", "flanger=", "rate=", "device-rate=", "filter=", "ir="])
     except getopt.GetoptError:
-        print('statsplay.py -f <inputfile> -d <device_index> -i <input_index> -v <volume>')
+        print(usage)
+        print(usage_render)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print(
-                'statsplay.py -f <inputfile> -d <device_index> -i <input_index> -v <volume>')
+            print(usage)
+            print(usage_render)
             sys.exit()
         elif opt in ("-f", "--file"):
             config['filename'] = arg
+        elif opt in ("-o", "--output"):
+            config['output'] = arg
         elif opt in ("-d", "--device"):
             config['device'] = int(arg)
         elif opt in ("-i", "--input"):
             config['input'] = int(arg)
         elif opt in ("-v", "--volume"):
-            config['volume'] = int(arg)
+            config['effects']['volume'] = int(arg)
+        elif opt in ("-b", "--buffer"):
+            config['chunk'] = int(arg)
+        elif opt in ("-t", "--duration"):
+            config['duration'] = float(arg)
+        elif opt == "--fps":
+            config['fps'] = float(arg)
+        elif opt == "--spectrum":
+            config['spectrum'] = True
+        elif opt == "--gui-process":
+            config['gui_process'] = True
+        elif opt == "--duplex":
+            config['duplex'] = True
+        elif opt == "--alloc-check":
+            config['alloc_check'] = int(arg)
+        elif opt == "--metrics":
+            metrics_target = arg
+        elif opt == "--profile":
+            profile_path = arg
+        elif opt == "--rate":
+            config['rate'] = int(arg)
+        elif opt == "--device-rate":
+            config['device_rate'] = int(arg)
+        elif opt == "--filter":
+            options['filter'] = arg
+            config['effects']['filter_enabled'] = True
+        elif opt == "--ir":
+            options['impulse_response'] = arg
+        elif opt == "--flanger":
+            config['effects']['flanger_mix'] = float(arg)
+        elif opt in ("--pan", "--tremolo"):
+            rate, _, shape = arg.partition(':')
+            config['effects'].update({
+                f'{opt[2:]}_rate': float(rate),
+                f'{opt[2:]}_shape': shape or 'sine',
+            })
+        elif opt == "--render":
+            if len(args) != 2:
+                print(usage_render)
+                sys.exit(2)
+            render_files = args
+
+    if config['alloc_check'] is not None and render_files is None \
+            and not config['gui_process']:
+        # tracemalloc counts every thread, so redraws of plots drawn in
+        # this process would be charged to the audio chunks
+        print("--alloc-check needs --render or --gui-process")
+        sys.exit(2)
 
-    if config['input'] == 0:
-        print('statsplay.py -f <inputfile> -d <device_index> -i <input_index> -v <volume>')
-        print("\nNo input selected -- Using default")
+    if render_files is None:
+        if config['input'] == 0:
+            print(usage)
+            print("\nNo input selected -- Using default")
 
-    print('Input index is ', config['input'])
-    print('Device index is ', config['device'])
+        print('Input index is ', config['input'])
+        print('Device index is ', config['device'])
 
-    run(config, data_array, input_array)
+    exporter = None
+    if metrics_target is not None:
+        config['metrics'] = Metrics(config['chunk'], options['framerate'])
+        exporter = MetricsExporter(config['metrics'], metrics_target)
+    if profile_path is not None:
+        config['profile'] = SpanRecorder()
+
+    try:
+        if render_files is not None:
+            render(config, *render_files)
+        elif config['gui_process']:
+            # the plots are drawn by another process, so the ring buffers
+            # have to be in shared memory
+            data_array = RingBuffer.shared(data_array.capacity)
+            input_array = RingBuffer.shared(input_array.capacity)
+            config['array'] = data_array
+            config['input_array'] = input_array
+            run_gui_process(config, data_array, input_array)
+        else:
+            run(config, data_array, input_array)
+    finally:
+        if exporter is not None:
+            exporter.close()
+            logging.info(f"Metrics: {config['metrics'].summary()}")
+        if profile_path is not None:
+            spans = config['profile'].dump(profile_path)
+            logging.info(f"Wrote {spans} spans to {profile_path}")
     sys.exit(0)
 
 
@@ -1,10 +1,9 @@
-import pyaudio
 import numpy as np
 
-audio = pyaudio.PyAudio()
+from backends import open_sink, open_source
 
 opt = {
-    'format': pyaudio.paInt32,
+    'sample_width': 4,
     'chans': 1,
     'sample_rate': 48000,
     'chunk_size': 1024,
@@ -15,11 +14,12 @@ opt = {
 }
 
 
-# create pyaudio stream object
-stream = audio.open(format=opt['format'], rate=opt['sample_rate'], channels=opt['chans'],
-                     input_device_index=opt['dev_index'], input=True, frames_per_buffer=opt['chunk_size'])
+# create source and sink, 'mic' and 'speaker' are the sound card
+stream = open_source('mic', opt['sample_rate'], opt['chans'], opt['sample_width'],
+                     device=opt['dev_index'], frames_per_buffer=opt['chunk_size'])
 
-stream_out = audio.open(format=opt['format'], rate=opt['sample_rate'], channels=opt['chans']+1, output_device_index=opt['out_index'], output=True, frames_per_buffer=opt['chunk_size'])
+stream_out = open_sink('speaker', opt['sample_rate'], opt['chans']+1, opt['sample_width'],
+                       device=opt['out_index'], frames_per_buffer=opt['chunk_size'])
 
 frames = []
 
@@ -34,8 +34,5 @@ for i in range(0, (opt['sample_rate']//opt['chunk_size'])*opt['record_secs']):
 print("Finished Recording.")
 
     # close resources
-stream.stop_stream()
 stream.close()
-stream_out.stop_stream()
 stream_out.close()
-audio.terminate()
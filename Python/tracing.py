@@ -0,0 +1,107 @@
+"""
+    tracing.py - Span recording for the --profile mode
+
+    Spans are kept in preallocated arrays, so recording one on the audio
+    thread is a dictionary lookup and three array stores. Nesting is not
+    tracked while recording, it is worked out from the start and end times
+    when the spans are written out.
+"""
+
+import json
+import time
+
+import numpy as np
+
+
+class SpanRecorder:
+    """
+    Fixed capacity buffer of named (start, end) perf_counter spans from a
+    single thread. Once full, the oldest spans are overwritten.
+
+    `record` has the signature of a Chain observer.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.names = []
+        self.ids = {}
+        self.name = np.zeros(capacity, dtype=np.int32)
+        self.start = np.zeros(capacity)
+        self.end = np.zeros(capacity)
+        self.count = 0
+        self.origin = time.perf_counter()
+
+    def record(self, name, start, end):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        j = self.count % self.capacity
+        self.name[j] = i
+        self.start[j] = start
+        self.end[j] = end
+        self.count += 1
+
+    def spans(self):
+        """
+        Returns
+        -------
+        (names, starts, ends) of the kept spans, ordered by start time with
+        enclosing spans first
+        """
+        n = min(self.count, self.capacity)
+        order = np.lexsort((-self.end[:n], self.start[:n]))
+        names = [self.names[i] for i in self.name[:n][order]]
+        return names, self.start[:n][order], self.end[:n][order]
+
+    def chrome_trace(self):
+        """
+        Spans as Chrome trace-event JSON, for chrome://tracing or Perfetto.
+        """
+        names, starts, ends = self.spans()
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': 1e6 * (start - self.origin),
+            'dur': 1e6 * (end - start),
+            'pid': 1,
+            'tid': 1,
+        } for name, start, end in zip(names, starts.tolist(), ends.tolist())]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def collapsed(self):
+        """
+        Self time of every stack of spans in microseconds, one
+        'outer;inner value' line per stack, the input flamegraph.pl and
+        speedscope take.
+        """
+        names, starts, ends = self.spans()
+        totals = {}
+        stack = []
+        for name, start, end in zip(names, starts.tolist(), ends.tolist()):
+            while stack and stack[-1][1] < end:
+                stack.pop()
+            path = (stack[-1][0] + ';' + name) if stack else name
+            duration = end - start
+            totals[path] = totals.get(path, 0.0) + duration
+            if stack:
+                totals[stack[-1][0]] -= duration
+            stack.append((path, end))
+        return ''.join(f"{path} {round(1e6 * seconds)}\n"
+                       for path, seconds in totals.items())
+
+    def dump(self, path):
+        """
+        Writes the spans to `path`, as a Chrome trace if it ends in .json
+        and as collapsed stacks otherwise.
+
+        Returns
+        -------
+        number of spans written
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.chrome_trace(), f)
+            else:
+                f.write(self.collapsed())
+        return min(self.count, self.capacity)
@@ -1,41 +1,24 @@
 import numpy as np
-import pyaudio
-import wave
 import sys
 import getopt
+import queue
+import threading
 import matplotlib.pyplot as plt
 
+from backends import MappedWavSource, open_sink
+from dsp import LFO
+from plotting import PlotRenderer, Trace
+from ringbuffer import RingBuffer
 
-def play_audio(file, device_index, volume, chunksize=4096):
-    """ Play an audio file """
-    wf = wave.open(file, 'rb')
 
-    p = pyaudio.PyAudio()
+def play_audio(file, device_index, volume, chunksize=4096, output='', fps=30,
+               read_ahead_chunks=8):
+    """ Play an audio file, to the output device or to the `output` sink """
+    # the file is memory mapped, chunks are read-only views of it
+    source = MappedWavSource(file)
 
-    stream = p.open(
-        format=p.get_format_from_width(wf.getsampwidth()),
-        channels=wf.getnchannels(),
-        rate=wf.getframerate(),
-        output=True,
-        output_device_index=device_index
-    )
-
-    data = wf.readframes(chunksize)
-
-    def fadefunc(x, rate=2):
-        """
-        Channel fade function.
-
-        Parameters
-        ----------
-        x : ndarray of sample positions
-        rate : rate of fade in samples
-
-        Returns
-        -------
-        ndarray of values 0-1, for relative fade between left and right channels
-        """
-        return (np.sin(rate * x * np.pi / wf.getframerate()) + 1) / 2
+    sink = open_sink(output, source.rate, source.channels, source.sample_width,
+                     device=device_index, frames_per_buffer=chunksize)
 
     def exp_distort(v, window=2):
         """
@@ -53,85 +36,134 @@ def play_audio(file, device_index, volume, chunksize=4096):
         ratio = 1 - np.exp(v-window) - np.exp(-v-window)
         return ratio
 
-    last_max = 0
+    def read_ahead():
+        """
+        Queues chunks ahead of the audio thread with their peak value.
+        Taking the peak touches every mapped page, so any disk reads
+        happen here rather than on the audio thread.
+        """
+        data = source.read_array(chunksize)
+        while data.size > 0:
+            if not put((data, np.max(np.abs(data)))):
+                return
+            data = source.read_array(chunksize)
+        put(None)
+
+    def put(item):
+        # gives up once playback is stopped, so a full queue can't hang
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def play():
+        """
+        Processes and writes the queued chunks, publishing each fade
+        curve for the plot.
+        """
+        last_max = 0
+        # sweeps the fade between the channels once a second
+        fader = LFO('sine', 1.0, source.rate)
+
+        while not stop.is_set():
+            try:
+                item = chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            data, max_value = item
 
-    fig, ax = plt.subplots()
-    ax.set_xlim(0, chunksize)
-    ax.set_ylim(0, 1)
-    # ax.set_aspect('equal')
+            if max_value > last_max:
+                last_max = max_value
 
-    # stores the position of each sample (in frames)
-    count = np.arange(0, chunksize)
-    count_x = np.arange(0, chunksize)
-    plot_points = ax.plot(count_x, fadefunc(count), 'b-')[0]
-    
-    plt.ion()
-    plt.show()
-    plt.pause(0.001)
+            # the first operation on the mapped samples makes the mutable
+            # float buffer, no separate copy is needed
+            buffer = data / last_max
 
-    # cache background
-    background = fig.canvas.copy_from_bbox(ax.bbox)
+            # isolates the left channel. [::2] will take every other element, starting at 0
+            left = buffer[::2]
+            # isolates the right channel. [1::2] will take every other element, starting at 1
+            right = buffer[1::2]
 
-    while len(data) > 0:
-        # read data from buffer into a mutable numpy array
-        buffer = np.frombuffer(data, dtype=np.int16).copy()
+            fade = fader.block(len(buffer) // 2)
 
-        max_value = np.max(np.abs(buffer))
-        if max_value > last_max:
-            last_max = max_value
+            # multiply the left and right channels by the fade value
+            # left[:] will modify the left channel in place, mutating the original buffer array
+            # note the cast to np.int16, numpy really wants it to be a float32
+            left[:] = (left[:] * fade)
+            # right[:] will modify the right channel in place, mutating the original buffer array
+            right[:] = (right[:] * (1-fade))
 
-        buffer = buffer / last_max
+            # distort the output
+            distort = exp_distort(buffer, 2)[:len(buffer)]
+            buffer = buffer * distort
 
-        # isolates the left channel. [::2] will take every other element, starting at 0
-        left = buffer[::2]
-        # isolates the right channel. [1::2] will take every other element, starting at 1
-        right = buffer[1::2]
+            buffer *= volume
 
-        fade = fadefunc(count, 2)[:len(buffer) // 2]
-        count += chunksize
+            # buffer tobytes() will convert the now mutated buffer array back to a python bytes object
+            # stream.write() will play the entire buffer (chunksize bytes)
+            sink.write(buffer.astype(np.int16, copy=False).tobytes())
 
-        # multiply the left and right channels by the fade value
-        # left[:] will modify the left channel in place, mutating the original buffer array
-        # note the cast to np.int16, numpy really wants it to be a float32
-        left[:] = (left[:] * fade)
-        # right[:] will modify the right channel in place, mutating the original buffer array
-        right[:] = (right[:] * (1-fade))
+            fade_ring.write(fade)
 
-        # distort the output
-        distort = exp_distort(buffer, 2)[:len(buffer)]
-        buffer = buffer * distort
+        stop.set()
 
-        buffer *= volume
+    # read-ahead -> bounded queue -> audio thread, with the plot sampling
+    # the latest fade curve on the main thread at no more than `fps`, so
+    # a slow or blocked window can't hold up the audio
+    chunks = queue.Queue(maxsize=read_ahead_chunks)
+    stop = threading.Event()
+    fade_ring = RingBuffer(2 * chunksize)
 
-        # buffer tobytes() will convert the now mutated buffer array back to a python bytes object
-        # stream.write() will play the entire buffer (chunksize bytes)
-        stream.write(buffer.astype(np.int16, copy=False).tobytes())
+    fig, ax = plt.subplots()
+    ax.set_xlim(0, chunksize // 4)
+    ax.set_ylim(0, 1)
+    # ax.set_aspect('equal')
 
-        # read the next chunk of data from the file
-        data = wf.readframes(chunksize)        
-        
-        plot_points.set_data(np.arange(fade.shape[0]), fade)
+    plot_points = ax.plot([], [], 'b-')[0]
+    renderer = PlotRenderer(fig, fps=fps)
+    renderer.add(ax, Trace(plot_points, fade_ring, chunksize, 4))
+    fig.canvas.mpl_connect('close_event', lambda event: stop.set())
 
-        fig.canvas.restore_region(background)
-        ax.draw_artist(plot_points)
-        fig.canvas.blit(ax.bbox)
+    plt.ion()
+    plt.show()
+    plt.pause(0.001)
+
+    reader = threading.Thread(target=read_ahead, daemon=True)
+    player = threading.Thread(target=play, daemon=True)
+    reader.start()
+    player.start()
 
-        plt.pause(0.0001)
+    try:
+        while player.is_alive():
+            renderer.wait()
+            renderer.draw()
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        stop.set()
+        reader.join()
+        player.join()
 
     print("* done *")
 
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
+    source.close()
+    sink.close()
 
 
 def main(argv):
     file = ''
     device_index = 0
     volume = 25000
+    output = ''
+    fps = 30
     try:
         opts, args = getopt.getopt(
-            argv, "hi:d:v:", ["ifile=", "device=", "volume="])
+            argv, "hi:d:v:o:", ["ifile=", "device=", "volume=", "output=", "fps="])
     except getopt.GetoptError:
         print('wavPlayer.py -i <inputfile> -d <device_index>')
         sys.exit(2)
@@ -145,15 +177,19 @@ def main(argv):
             device_index = int(arg)
         elif opt in ("-v", "--volume"):
             volume = int(arg)
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt == "--fps":
+            fps = float(arg)
 
     if file == '':
-        print('wavPlayer.py -i <inputfile> -d <device_index> -v <volume>')
+        print('wavPlayer.py -i <inputfile> -d <device_index> -v <volume> -o <outputfile|null> [--fps <plot_fps>]')
         sys.exit(2)
 
     print('Input file is "', file)
     print('Device index is ', device_index)
 
-    play_audio(file, device_index, volume)
+    play_audio(file, device_index, volume, output=output, fps=fps)
     sys.exit(0)
 
 
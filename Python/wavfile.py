@@ -0,0 +1,116 @@
+"""
+    wavfile.py - Memory mapped wav file reading
+
+    The file is mapped once and the RIFF header parsed once. After that
+    every read is a read-only NumPy view of the mapped sample data, so
+    nothing is copied or read from disk until the samples are touched, and
+    seeking is just moving an offset.
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# 8 bit wav samples are unsigned, wider ones signed little endian
+SAMPLE_DTYPES = {1: np.dtype(np.uint8), 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+
+class MappedWav:
+    """
+    PCM wav file mapped into memory.
+
+    Parameters
+    ----------
+    filename : path of an 8, 16 or 32 bit PCM wav file
+
+    Attributes
+    ----------
+    rate, channels, sample_width : format of the file
+    nframes : number of frames in the file
+    frames : read-only (nframes, channels) view of all the samples
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except Exception:
+            self.map.close()
+            raise
+        self.position = 0
+
+    def _parse(self):
+        buf = self.map
+        if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+            raise ValueError("Not a RIFF/WAVE file")
+
+        fmt = None
+        data = None
+        offset = 12
+        while offset + 8 <= len(buf):
+            chunk_id = buf[offset:offset + 4]
+            size, = struct.unpack_from('<I', buf, offset + 4)
+            start = offset + 8
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', buf, start)
+                if fmt[0] == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                    # the real format is the first two bytes of the GUID
+                    fmt = (struct.unpack_from('<H', buf, start + 24)[0],) + fmt[1:]
+            elif chunk_id == b'data':
+                # files that were never finalized can claim more data than
+                # they hold, or 0xFFFFFFFF when streamed
+                data = (start, min(size, len(buf) - start))
+                break
+            # chunks are padded to an even length
+            offset = start + size + (size & 1)
+
+        if fmt is None or data is None:
+            raise ValueError("Missing fmt or data chunk")
+        format_tag, channels, rate, _, block_align, bits = fmt
+        if format_tag != WAVE_FORMAT_PCM:
+            raise ValueError(f"Unsupported wav format {format_tag:#x}")
+        sample_width = bits // 8
+        if sample_width not in SAMPLE_DTYPES or block_align != channels * sample_width:
+            raise ValueError(f"Unsupported sample width of {bits} bits")
+
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.dtype = SAMPLE_DTYPES[sample_width]
+        self.nframes = data[1] // block_align
+        self.frames = np.frombuffer(buf, dtype=self.dtype,
+                                    count=self.nframes * channels,
+                                    offset=data[0]).reshape(-1, channels)
+
+    def seek(self, frame):
+        """
+        Moves the read position to `frame`, clamped to the file.
+        """
+        self.position = max(0, min(frame, self.nframes))
+
+    def tell(self):
+        return self.position
+
+    def read(self, n):
+        """
+        Returns a read-only (frames, channels) view of up to `n` frames
+        from the read position, and moves past them. The view is empty at
+        the end of the file.
+        """
+        start = self.position
+        self.position = min(start + n, self.nframes)
+        return self.frames[start:self.position]
+
+    def close(self):
+        # the views have to go before the map can be closed
+        self.frames = None
+        try:
+            self.map.close()
+        except BufferError:
+            # a caller still holds a view, the map goes with it
+            pass